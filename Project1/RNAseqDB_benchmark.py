@@ -0,0 +1,187 @@
+# ---- load packages ---- #
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+
+import RNAseqDB_fetch as fetch
+from RNAseqDB_mock_server import MockServerConfig, ServeMockDb, TREATMENTS
+
+# ---- info ---- #
+
+# end-to-end throughput benchmark of the RNAseqDB_fetch pipeline against the
+# local mock database (RNAseqDB_mock_server.py), no network needed
+# every case runs main() in a fresh process so peak memory is per case
+
+
+# ---- params ---- #
+
+@dataclass
+class BenchmarkCase:
+    '''
+    one benchmark run: list size x pattern count
+    '''
+    n_genes: int = field(default=1000)
+    n_patterns: int = field(default=0)
+    workers: int = field(default=8)
+    parse_workers: int = field(default=0)
+    out_format: str = field(default='csv')
+    db_url: str = field(default='http://127.0.0.1:8765/athrdb/')
+
+
+# ---- utils ---- #
+
+
+def SyntheticGeneList(path, n_genes, seed=0):
+    '''
+    write n_genes distinct AGI-style IDs to a csv gene list
+    '''
+    rng = random.Random(seed)
+    ids = rng.sample(range(1, 5 * 99999), n_genes)
+    with open(path, 'w') as w_file:
+        for number in ids:
+            w_file.write(f'AT{number // 99999 + 1}G{number % 99999:05d}\n')
+
+
+def Percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def PeakMemoryMb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def RunCase(case: BenchmarkCase):
+    '''
+    run main() for one case in the current process, returns a report dict
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gene_list = os.path.join(tmp_dir, 'genes.csv')
+        SyntheticGeneList(gene_list, case.n_genes)
+        metadata = fetch.QueryMetaData(db_url=case.db_url,
+                                       gene_list=gene_list,
+                                       out_dir=tmp_dir,
+                                       data_pattern='_'.join(TREATMENTS[:case.n_patterns]),  # noqa
+                                       workers=case.workers,
+                                       max_per_host=case.workers,
+                                       parse_workers=case.parse_workers,
+                                       out_format=case.out_format,
+                                       metrics_format='json')
+        logging.basicConfig(filename=os.path.join(tmp_dir, 'message.log'),
+                            format='%(asctime)s - **%(levelname)s**: %(message)s',  # noqa
+                            level=logging.INFO, force=True)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):  # noqa
+            fetch.main(metadata)
+        wall = time.perf_counter() - start
+        with open(os.path.join(tmp_dir, 'metrics.json')) as r_file:
+            metrics = json.load(r_file)
+    # per-gene stage times, a written batch is shared evenly by its genes
+    stages = {stage: [record[stage]['seconds'] for record in metrics['genes'].values() if stage in record]  # noqa
+              for stage in fetch.RunMetrics.stages}
+    report = asdict(case)
+    report['wall_s'] = wall
+    report['genes_per_s'] = case.n_genes / wall
+    for stage, durations in stages.items():
+        report[f'{stage}_calls'] = len(durations)
+        report[f'{stage}_p50_ms'] = Percentile(durations, 50) * 1000
+        report[f'{stage}_p99_ms'] = Percentile(durations, 99) * 1000
+    report['requests'] = metrics['counters'].get('requests', 0)
+    report['retries'] = metrics['counters'].get('retries', 0)
+    report['peak_mem_mb'] = PeakMemoryMb()
+    return report
+
+
+def PrintReport(reports):
+    columns = ['n_genes', 'n_patterns', 'workers', 'genes_per_s',
+               'presearch_p50_ms', 'presearch_p99_ms', 'fetch_p50_ms',
+               'fetch_p99_ms', 'format_p50_ms', 'format_p99_ms',
+               'write_p50_ms', 'write_p99_ms', 'peak_mem_mb']
+    print(' | '.join(columns))
+    for report in reports:
+        cells = []
+        for column in columns:
+            value = report[column]
+            cells.append(f'{value:.2f}' if isinstance(value, float) else str(value))  # noqa
+        print(' | '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the fetch pipeline against a local mock database.')  # noqa
+    parser.add_argument('--sizes', type=str, default='100,1000,10000,30000',
+                        help='Comma-separated gene list sizes (default: 100,1000,10000,30000)')  # noqa
+    parser.add_argument('--patterns', type=str, default='0,1,5,20',
+                        help=f'Comma-separated pattern counts, at most {len(TREATMENTS)} (default: 0,1,5,20)')  # noqa
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Concurrent fetch workers (default: 8)')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Formatting processes passed to the pipeline (default: 0)')  # noqa
+    parser.add_argument('--out-format', type=str, default='csv',
+                        help='Output format passed to the pipeline (default: csv)')  # noqa
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port of the mock database (default: 8765)')
+    parser.add_argument('--latency-ms', type=float, default=5,
+                        help='Mean latency of the mock database in ms (default: 5)')  # noqa
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of 503 answers of the mock database (default: 0)')  # noqa
+    parser.add_argument('--treatments', type=int, default=60,
+                        help='Treatment_project entries per gene (default: 60)')  # noqa
+    parser.add_argument('--json', type=str, default='',
+                        help='Also write all reports to this json file')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    patterns = [int(pattern) for pattern in args.patterns.split(',')]
+    if max(patterns) > len(TREATMENTS):
+        raise ValueError(f'At most {len(TREATMENTS)} patterns are available, but got {max(patterns)}!')  # noqa
+    server_config = MockServerConfig(port=args.port,
+                                     latency_ms=args.latency_ms,
+                                     error_rate=args.error_rate,
+                                     treatments=args.treatments)
+    ctx = mp.get_context('spawn')
+    server = ctx.Process(target=ServeMockDb, args=(server_config,), daemon=True)  # noqa
+    server.start()
+    time.sleep(1)  # let the server bind its port
+    reports = []
+    try:
+        for n_genes in sizes:
+            for n_patterns in patterns:
+                case = BenchmarkCase(n_genes=n_genes,
+                                     n_patterns=n_patterns,
+                                     workers=args.workers,
+                                     parse_workers=args.parse_workers,
+                                     out_format=args.out_format,
+                                     db_url=f'http://127.0.0.1:{args.port}/athrdb/')  # noqa
+                # a fresh process per case keeps peak memory and state apart
+                with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:  # noqa
+                    report = executor.submit(RunCase, case).result()
+                print(f'{n_genes} genes, {n_patterns} patterns: {report["genes_per_s"]:.1f} genes/s')  # noqa
+                reports.append(report)
+    finally:
+        server.terminate()
+        server.join()
+    PrintReport(reports)
+    if args.json != '':
+        with open(args.json, 'w') as w_file:
+            json.dump(reports, w_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
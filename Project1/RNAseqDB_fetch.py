@@ -3,9 +3,31 @@
 import requests as rq
 import os
 import logging
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 import pandas as pd
+import numpy as np
 import argparse
+import threading
+import random
+import time
+import hashlib
+import json
+import zlib
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import gzip
+import sys
+import shutil
+import multiprocessing as mp
+import re
+import sqlite3
+from array import array
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 from dataclasses import dataclass, field, asdict
@@ -19,6 +41,11 @@ from dataclasses import dataclass, field, asdict
 # reorganize code and improve readability
 
 
+logger = logging.getLogger(__name__)
+# per-gene progress messages, can be sampled to keep logging cheap
+gene_logger = logging.getLogger(f'{__name__}.genes')
+
+
 # ---- params ---- #
 
 @dataclass
@@ -35,10 +62,72 @@ class QueryMetaData:
     list_sep: str = field(default=',',
                           metadata={'help': 'separator in gene list'})
     data_tag: str = field(default='tbox',
-                          metadata={'help': 'data source to be downloaded'})
+                          metadata={'help': 'data source(s) to be downloaded, comma-separated'})  # noqa
     data_pattern: str = field(default='',
                               metadata={'help': 'data type to be extracted'})
     out_dir: str = field(default=os.path.dirname(__file__))
+    workers: int = field(default=1,
+                         metadata={'help': 'number of genes fetched concurrently'})  # noqa
+    max_per_host: int = field(default=4,
+                              metadata={'help': 'max in-flight requests per host'})  # noqa
+    connect_timeout: float = field(default=10,
+                                   metadata={'help': 'seconds to wait for a connection'})  # noqa
+    read_timeout: float = field(default=60,
+                                metadata={'help': 'seconds to wait for a response'})  # noqa
+    max_retries: int = field(default=4,
+                             metadata={'help': 'retries on 429 / 5xx / connection errors'})  # noqa
+    max_rate: float = field(default=0,
+                            metadata={'help': 'max requests per second, 0 for no cap until the server throttles'})  # noqa
+    breaker_threshold: int = field(default=10,
+                                   metadata={'help': 'failed requests in a row before pausing'})  # noqa
+    breaker_pause: float = field(default=60,
+                                 metadata={'help': 'seconds to pause once the circuit opens'})  # noqa
+    cache_dir: str = field(default='',
+                           metadata={'help': 'directory of raw payload cache, empty to disable'})  # noqa
+    cache_ttl: float = field(default=7 * 24,
+                             metadata={'help': 'hours a cached payload stays valid'})  # noqa
+    cache_max_mb: float = field(default=1024,
+                                metadata={'help': 'size cap of payload cache in MB'})  # noqa
+    cache_only: bool = field(default=False,
+                             metadata={'help': 'serve payloads from cache only, no network'})  # noqa
+    optimistic: bool = field(default=False,
+                             metadata={'help': 'fetch result files first, pre-search only if missing'})  # noqa
+    refresh: bool = field(default=False,
+                          metadata={'help': 'only format and write genes whose data changed'})  # noqa
+    parse_workers: int = field(default=0,
+                               metadata={'help': 'processes formatting payloads, 0 to format in main process'})  # noqa
+    queue_size: int = field(default=0,
+                            metadata={'help': 'genes held between two stages, 0 for 4 x workers'})  # noqa
+    metrics_format: str = field(default='json',
+                                metadata={'help': 'run metrics file: json, prometheus or none'})  # noqa
+    profile: bool = field(default=False,
+                          metadata={'help': 'profile the formatting stage'})  # noqa
+    gene_log_sample: int = field(default=1,
+                                 metadata={'help': 'log progress of every n-th gene, 0 for none'})  # noqa
+    pattern_overlap: str = field(default='duplicate',
+                                 metadata={'help': 'rows matching several patterns: duplicate or first'})  # noqa
+    id_pattern: str = field(default=r'AT[1-5CM]G\d{5}(\.\d+)?',
+                            metadata={'help': 'regex valid gene IDs must match, empty to disable'})  # noqa
+    shard: str = field(default='',
+                       metadata={'help': 'i/N, only fetch the i-th of N hash partitions of the gene list'})  # noqa
+    out_format: str = field(default='csv',
+                            metadata={'help': 'output format: csv, parquet or feather'})  # noqa
+    partition_by_keyword: bool = field(default=False,
+                                      metadata={'help': 'partition columnar output by keyword'})  # noqa
+    matrix: bool = field(default=False,
+                         metadata={'help': 'also write gene x treatment_project matrices'})  # noqa
+    store: str = field(default='',
+                       metadata={'help': 'SQLite file all formatted rows are also stored in, empty to disable'})  # noqa
+    summary: bool = field(default=False,
+                          metadata={'help': 'also write per keyword / treatment summary statistics'})  # noqa
+    batch_rows: int = field(default=10000,
+                            metadata={'help': 'rows buffered before results are written'})  # noqa
+    batch_mb: float = field(default=8,
+                            metadata={'help': 'MB buffered before results are written'})  # noqa
+    resume: bool = field(default=False,
+                         metadata={'help': 'skip genes already written according to journal'})  # noqa
+    retry_failed: bool = field(default=False,
+                               metadata={'help': 'only re-run genes that failed according to journal'})  # noqa
 
 
 @dataclass
@@ -108,13 +197,205 @@ class RequestSessionConfiguration:
 # ---- utils ---- #
 
 
-def ReadGenesfromList(gene_list, list_format, list_sep):
+class GeneLogSampler(logging.Filter):
+    '''
+    only let per-gene messages of about one in every n genes through,
+    chosen by a hash of the gene ID (the first message argument)
+    so all messages of a sampled gene are kept together
+    '''
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+
+    def filter(self, record):
+        gene = record.args[0] if record.args else ''
+        return zlib.crc32(str(gene).encode('utf-8')) % self.every == 0
+
+
+class RunMetrics:
+    '''
+    wall time and bytes of every pipeline stage, per gene and in aggregate,
+    plus run counters (requests, retries, cache hits, ...),
+    optionally cProfile / tracemalloc on one stage
+    '''
+    stages = ('presearch', 'fetch', 'format', 'write')
+
+    def __init__(self, profile_stage=None):
+        self.profile_stage = profile_stage
+        self.aggregate = {stage: {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0} for stage in self.stages}  # noqa
+        self.genes = {}
+        self.counters = {}
+        self.peak_mem = 0
+        self._lock = threading.Lock()
+        self._profiler = None
+        if profile_stage is not None:
+            self._profiler = cProfile.Profile()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def Inc(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def Record(self, stage, genes, seconds, n_bytes=0):
+        '''
+        genes is one gene ID or a list of genes sharing the stage
+        (a written batch), which then get an even share each
+        '''
+        genes = [genes] if isinstance(genes, str) else list(genes or [])
+        with self._lock:
+            total = self.aggregate[stage]
+            total['calls'] += 1
+            total['seconds'] += seconds
+            total['max_seconds'] = max(total['max_seconds'], seconds)
+            total['bytes'] += n_bytes
+            for gene in genes:
+                self.genes.setdefault(gene, {})[stage] = {'seconds': seconds / len(genes), 'bytes': n_bytes // len(genes)}  # noqa
+
+    @contextlib.contextmanager
+    def Stage(self, stage, genes=None):
+        '''
+        time the enclosed block, the caller may set record['bytes']
+        '''
+        record = {'bytes': 0}
+        profiling = stage == self.profile_stage
+        if profiling:
+            tracemalloc.reset_peak()
+            self._profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            if profiling:
+                self._profiler.disable()
+                self.peak_mem = max(self.peak_mem, tracemalloc.get_traced_memory()[1])  # noqa
+            self.Record(stage, genes, seconds, record['bytes'])
+
+    def AsDict(self):
+        return {'stages': self.aggregate,
+                'counters': self.counters,
+                'genes': self.genes}
+
+    def AsPrometheus(self):
+        lines = []
+        for name, key, help_text in (('rnaseqdb_stage_calls_total', 'calls', 'Number of times a stage ran'),  # noqa
+                                     ('rnaseqdb_stage_seconds_total', 'seconds', 'Wall time spent in a stage'),  # noqa
+                                     ('rnaseqdb_stage_seconds_max', 'max_seconds', 'Longest single run of a stage'),  # noqa
+                                     ('rnaseqdb_stage_bytes_total', 'bytes', 'Bytes handled by a stage')):  # noqa
+            metric_type = 'gauge' if key == 'max_seconds' else 'counter'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for stage, total in self.aggregate.items():
+                lines.append(f'{name}{{stage="{stage}"}} {total[key]}')
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE rnaseqdb_{counter}_total counter')
+            lines.append(f'rnaseqdb_{counter}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def Dump(self, out_dir, metrics_format='json'):
+        '''
+        write metrics (and the profile of the profiled stage) into out_dir,
+        returns the path of the metrics file
+        '''
+        path = None
+        if metrics_format == 'json':
+            path = os.path.join(out_dir, 'metrics.json')
+            with open(path, 'w') as w_file:
+                json.dump(self.AsDict(), w_file, indent=1)
+        elif metrics_format == 'prometheus':
+            path = os.path.join(out_dir, 'metrics.prom')
+            with open(path, 'w') as w_file:
+                w_file.write(self.AsPrometheus())
+        if self._profiler is not None:
+            prof_path = os.path.join(out_dir, f'{self.profile_stage}_profile.prof')  # noqa
+            self._profiler.dump_stats(prof_path)
+            with open(os.path.join(out_dir, f'{self.profile_stage}_profile.txt'), 'w') as w_file:  # noqa
+                w_file.write(f'peak traced memory during {self.profile_stage}: {self.peak_mem / 1024 / 1024:.1f} MB\n')  # noqa
+                stats = pstats.Stats(prof_path, stream=w_file)
+                stats.sort_stats('cumulative').print_stats(40)
+        return path
+
+
+def StageTimer(metrics, stage, genes=None):
+    '''
+    metrics.Stage or a no-op when no metrics are collected
+    '''
+    if metrics is None:
+        return contextlib.nullcontext({'bytes': 0})
+    return metrics.Stage(stage, genes)
+
+
+class GeneListReader:
     '''
-    extract gene names / IDs from gene_list file provided
-    store them in list[genes]
+    lazily iterate over gene IDs of a (optionally gzipped) gene list,
+    blanks and duplicates are dropped while keeping the order,
+    IDs not matching id_pattern are put aside in invalid_genes
+    '''
+    def __init__(self, gene_list, list_sep, id_pattern=''):
+        self.gene_list = gene_list
+        self.list_sep = list_sep
+        self.id_regex = re.compile(id_pattern) if id_pattern != '' else None
+        self.n_genes = 0
+        self.n_duplicates = 0
+        self.invalid_genes = []
+
+    def IterGenes(self, tokens, report=True):
+        '''
+        normalize, de-duplicate and check raw gene IDs of any iterable,
+        counters and invalid genes are only kept if report is True
+        '''
+        seen = set()
+        for gene in tokens:
+            gene = gene.strip().upper()
+            if gene == '':
+                continue
+            if gene in seen:
+                if report:
+                    self.n_duplicates += 1
+                continue
+            seen.add(gene)
+            if self.id_regex is not None and self.id_regex.fullmatch(gene) is None:  # noqa
+                if report:
+                    logger.warning(f'Gene ID {gene} is skipped since it does not look like a valid ID')  # noqa
+                    self.invalid_genes.append(gene)
+                continue
+            if report:
+                self.n_genes += 1
+            yield gene
+
+    def _ReadTokens(self):
+        opener = gzip.open if self.gene_list.endswith('.gz') else open
+        try:
+            with opener(self.gene_list, 'rt') as gl:
+                for line in gl:
+                    yield from line.split(self.list_sep)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f'Reading of gene list failed: {e}')
+            raise RuntimeError('Gene list cannot be read correctly, please make sure the file is not corrupted') from e  # noqa
+
+    def __iter__(self):
+        yield from self.IterGenes(self._ReadTokens())
+        logger.info('Reading gene list is finished')
+
+    def CountGenes(self, select=None):
+        '''
+        number of genes a separate pass over the list yields, after
+        select (e.g. shard / resume filters) if given, so progress bars
+        get a total without holding the gene list in memory
+        '''
+        genes = self.IterGenes(self._ReadTokens(), report=False)
+        if select is not None:
+            genes = select(genes)
+        return sum(1 for _ in genes)
+
+
+def ReadGenesfromList(gene_list, list_format, list_sep, id_pattern=''):
+    '''
+    extract gene names / IDs from gene_list file provided,
+    the file is checked right away but read lazily while genes are consumed
     '''
     logger.info('Reading gene list is started')
-    genes = []
     if gene_list == '':
         raise ValueError('The full path for gene list cannot be empty!')  # noqa
     if not isinstance(gene_list, str):
@@ -125,20 +406,173 @@ def ReadGenesfromList(gene_list, list_format, list_sep):
         raise ValueError(f'Gene list can only be in the form of either ".csv" file or ".txt" file, but got {list_format}!')  # noqa
     if list_sep not in [',', ';', '\t']:
         raise ValueError(f'Delimiter can only be in the form of either comma, semicolon or tab, but got {list_sep}')
+    return GeneListReader(gene_list, list_sep, id_pattern)
+
+
+def ParseShard(shard):
+    '''
+    'i/N' into (i, N), shards are numbered from 1 to N
+    '''
     try:
-        with open(gene_list, 'r') as gl:
-            while True:
-                line = gl.readline()
-                if line == '':
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError as e:
+        raise ValueError(f'Shard must be given as i/N, e.g. 1/4, but got {shard}!') from e  # noqa
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f'Shard index must be between 1 and N, but got {shard}!')  # noqa
+    return index, count
+
+
+def GeneShard(gene, n_shards):
+    '''
+    shard (1 to n_shards) of a gene ID, the same on every machine and run
+    '''
+    return zlib.crc32(gene.encode('utf-8')) % n_shards + 1
+
+
+def ShardGenes(genes, shard):
+    '''
+    keep only the genes of shard 'i/N', all genes if shard is empty
+    '''
+    if shard == '':
+        return genes
+    index, count = ParseShard(shard)
+    return (gene for gene in genes if GeneShard(gene, count) == index)
+
+
+def ShardDirName(index, count):
+    return f'shard-{index}-of-{count}'
+
+
+class RequestTransport:
+    '''
+    wrap the request session with connect / read timeouts, retries with
+    exponential backoff and jitter on 429 / 5xx / connection errors,
+    an adaptive request rate that halves when the server throttles and
+    slowly recovers (without max_rate requests are not spaced until the
+    first throttling, which starts from the rate requests went out at), and a circuit breaker that pauses all workers after
+    too many failures in a row instead of failing gene after gene,
+    get() has the same signature as requests.Session.get
+    '''
+    retry_status = (429, 500, 502, 503, 504)
+    throttle_status = (429, 503)
+
+    def __init__(self, session, connect_timeout=10, read_timeout=60,
+                 max_retries=4, backoff_base=1, backoff_max=60,
+                 max_rate=0, breaker_threshold=10, breaker_pause=60):
+        if max_retries < 0:
+            raise ValueError(f'Number of retries cannot be negative, but got {max_retries}!')  # noqa
+        if max_rate < 0:
+            raise ValueError(f'Max request rate cannot be negative, but got {max_rate}!')  # noqa
+        if breaker_threshold < 1:
+            raise ValueError(f'Circuit breaker threshold must be at least 1, but got {breaker_threshold}!')  # noqa
+        self.session = session
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_rate = max_rate
+        self.min_rate = min(max_rate, 0.2) if max_rate > 0 else 0.2
+        # None sends requests unspaced, until the server throttles
+        self.rate = max_rate if max_rate > 0 else None
+        self._full_rate = max_rate  # rate recovered to after throttling
+        self._sent = deque(maxlen=20)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_pause = breaker_pause
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_throttled = 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._consecutive_failures = 0
+        self._paused_until = 0.0
+
+    def _WaitForSlot(self):
+        '''
+        block while the circuit is open, then until the next request
+        may be sent according to the current rate
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    if self.rate is None:
+                        wait = 0.0
+                        self._next_slot = now
+                    else:
+                        wait = max(0.0, self._next_slot - now)
+                        self._next_slot = max(now, self._next_slot) + 1 / self.rate  # noqa
+                    self._sent.append(now + wait)
+                    self.n_requests += 1
                     break
-                gene_id = line.split(list_sep)
-                gene_id = [gene.strip().upper() for gene in gene_id]
-                genes += gene_id
-    except Exception as e:
-        logger.error(f'Reading of gene list failed: {e}')
-        raise f'Gene list cannot be read correctly, please make sure the file is not corrupted' from e
-    logger.info('Reading gene list is finished')
-    return genes
+                wait = self._paused_until - now
+            time.sleep(wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _RecordSuccess(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            if self.rate is None:
+                return
+            # additive increase, back to full rate after ~20 good requests
+            self.rate += self._full_rate / 20
+            if self.rate >= self._full_rate:
+                self.rate = self.max_rate if self.max_rate > 0 else None
+
+    def _RecordFailure(self, throttled):
+        with self._lock:
+            self._consecutive_failures += 1
+            if throttled:
+                self.n_throttled += 1
+                if self.rate is None:
+                    # no cap so far, start from the rate of recent requests
+                    span = self._sent[-1] - self._sent[0] if len(self._sent) > 1 else 0.0  # noqa
+                    self._full_rate = (len(self._sent) - 1) / span if span > 0 else 1.0  # noqa
+                    self.rate = self._full_rate
+                # multiplicative decrease
+                self.rate = max(self.min_rate, self.rate / 2)
+            if self._consecutive_failures >= self.breaker_threshold:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._paused_until = now + self.breaker_pause
+                    logger.warning(f'{self._consecutive_failures} requests failed in a row, all requests are paused for {self.breaker_pause} s')  # noqa
+
+    def _Backoff(self, attempt, response=None):
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass  # http-date form, fall back to backoff
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))  # noqa
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self._WaitForSlot()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (rq.ConnectionError, rq.Timeout) as e:
+                self._RecordFailure(throttled=False)
+                if attempt == self.max_retries:
+                    raise e
+                delay = self._Backoff(attempt)
+                logger.warning(f'Request to {url} failed ({e}), retry in {delay:.1f} s')  # noqa
+            else:
+                if response.status_code not in self.retry_status:
+                    self._RecordSuccess()
+                    return response
+                self._RecordFailure(throttled=response.status_code in self.throttle_status)  # noqa
+                if attempt == self.max_retries:
+                    return response
+                delay = self._Backoff(attempt, response)
+                logger.warning(f'Request to {url} got status {response.status_code}, retry in {delay:.1f} s')  # noqa
+            with self._lock:
+                self.n_retries += 1
+            time.sleep(delay)
 
 
 def ConductPreSearch(gene, session, db_url):
@@ -147,192 +581,1703 @@ def ConductPreSearch(gene, session, db_url):
     to trigger data deposit as cache / cookies
     enabling further fetching process
     '''
-    logger.info(f'Pre-search for gene {gene} is started (1/4)')
+    gene_logger.info('Pre-search for gene %s is started (1/4)', gene)
     server_url = urljoin(db_url, 'Search.php')
     query_value = f'{gene}/0/max////'
     params = {'query': query_value}
     try:
         # session = rq.Session()
-        response = session.get(server_url, params=params, timeout=10)
+        response = session.get(server_url, params=params)
         # logger.info(f'Conducting pre-search for gene {gene} in database {db_url}...')  # noqa
         if response.status_code == 200:
-            logger.info(f'Pre-search is done for gene {gene}')
+            gene_logger.info('Pre-search is done for gene %s', gene)
         else:
             logger.error(f'Unexpected status code got when carring out pre-search for gene {gene}: {response.status_code}')  # noqa
             raise ConnectionError(f'STEP 1 - presearch for gene {gene} failed')
     except Exception as e:
         #logger.error(f'Error occured when carrying out pre-search for gene {gene} from database')  # noqa
         raise e
-    logger.info(f'Pre-search for gene {gene} is finished (1/4)')
+    gene_logger.info('Pre-search for gene %s is finished (1/4)', gene)
     return session
 
 
-def FetchGeneData(session, gene, db_url, data_tag):
+def FetchGeneData(session, gene, db_url, data_tag, missing_ok=False,
+                  refresh=None):
+    '''
+    download the result file of one gene, with missing_ok a file
+    not (yet) produced by the server gives None instead of an error,
+    with a RefreshState the request is conditional and a file unchanged
+    since the last run gives RefreshState.unchanged
+    '''
     content = None
     target_url = f'{db_url}user/{gene}.{data_tag}'
-    logger.info(f'Fetching process for gene {gene} is started (2/4)')
+    gene_logger.info('Fetching process for gene %s is started (2/4)', gene)
     try:
-        response = session.get(target_url)
+        headers = refresh.Headers(gene, data_tag) if refresh is not None else None  # noqa
+        response = session.get(target_url, headers=headers)
+        if missing_ok and response.status_code == 404:
+            gene_logger.info('Result file of gene %s is not on the server yet: %s', gene, target_url)  # noqa
+            return None
         if response.status_code == 200:
             # logger.info(f'Successfully fetched data for gene {gene}')
             content = response.content.decode('utf-8')
-        else:
+        elif refresh is None or response.status_code != 304:
             logger.error(f'Data for gene {gene} cannot be found.')
             raise RuntimeError(f'STEP2 - data fetch for gene {gene} failed')
+        if refresh is not None and refresh.Check(gene, data_tag, response, content):  # noqa
+            gene_logger.info('Result file of gene %s is unchanged since the last run: %s', gene, target_url)  # noqa
+            return RefreshState.unchanged
     except Exception as e:
         #logger.error(f'Error occured when fetching data for gene {gene}: {e}')
         raise e
-    logger.info(f'Fetching process for gene {gene} is finished (2/4)')
+    gene_logger.info('Fetching process for gene %s is finished (2/4)', gene)
     return content
 
 
-def FormatRawDataFromDb(gene, content, data_pattern):
-    results = None
-    pattern_list = []
+class HostRequestLimiter:
+    '''
+    cap the number of in-flight requests per host
+    shared by all fetch workers of one run
+    '''
+    def __init__(self, max_per_host):
+        if max_per_host < 1:
+            raise ValueError(f'Max in-flight requests per host must be at least 1, but got {max_per_host}!')  # noqa
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def Slot(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)  # noqa
+            return self._semaphores[host]
+
+
+class PayloadCache:
+    '''
+    on-disk cache of raw decoded payloads keyed by target url,
+    file mtime marks when a payload was fetched (ttl),
+    file atime marks when it was last used (lru eviction)
+    '''
+    suffix = '.payload'
+
+    def __init__(self, cache_dir, ttl_hours, max_mb):
+        if ttl_hours <= 0:
+            raise ValueError(f'Cache ttl must be positive, but got {ttl_hours}!')  # noqa
+        if max_mb <= 0:
+            raise ValueError(f'Cache size cap must be positive, but got {max_mb}!')  # noqa
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._sizes = {}
+        for name in os.listdir(cache_dir):
+            if name.endswith(self.suffix):
+                path = os.path.join(cache_dir, name)
+                self._sizes[path] = os.path.getsize(path)
+        self._total = sum(self._sizes.values())
+
+    def PathFor(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + self.suffix)
+
+    def Get(self, url):
+        path = self.PathFor(url)
+        with self._lock:
+            if path not in self._sizes:
+                return None
+            now = time.time()
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    self._Remove(path)
+                    return None
+                with open(path, 'r', encoding='utf-8') as r_file:
+                    content = r_file.read()
+                os.utime(path, (now, os.path.getmtime(path)))
+            except FileNotFoundError:
+                # removed by another run sharing the cache dir, or by hand
+                self._Remove(path)
+                return None
+        return content
+
+    def Put(self, url, content):
+        path = self.PathFor(url)
+        data = content.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as w_file:
+            w_file.write(data)
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._total += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            self._Evict()
+
+    def _Remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._total -= self._sizes.pop(path, 0)
+
+    @staticmethod
+    def _LastUse(path):
+        try:
+            return os.path.getatime(path)
+        except FileNotFoundError:
+            return 0.0  # already removed, dropped from the index first
+
+    def _Evict(self):
+        if self._total <= self.max_bytes:
+            return
+        by_last_use = sorted(self._sizes, key=self._LastUse)
+        for path in by_last_use:
+            if self._total <= self.max_bytes:
+                break
+            self._Remove(path)
+
+
+def ReadCache(cache, url, gene):
+    '''
+    cached payload of url, a cache that cannot be read counts as a miss
+    '''
+    try:
+        return cache.Get(url)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Payload cache cannot be read for gene {gene}, it is fetched instead: {e}')  # noqa
+        return None
+
+
+def WriteCache(cache, url, content, gene):
+    '''
+    cache a payload, a failure only costs a later fetch
+    '''
+    try:
+        cache.Put(url, content)
+    except OSError as e:
+        logger.warning(f'Payload of gene {gene} cannot be cached: {e}')
+
+
+def SplitDataTags(data_tag):
+    '''
+    data tags given as comma-separated str, blanks and duplicates dropped
+    '''
+    data_tags = list(dict.fromkeys(tag.strip() for tag in data_tag.split(',') if tag.strip() != ''))  # noqa
+    if len(data_tags) == 0:
+        raise ValueError('At least one data tag must be given!')
+    return data_tags
+
+
+class RefreshState:
+    '''
+    validators (ETag / Last-Modified) and content hash of every result
+    file fetched for an output in out_dir, lets a refresh run send
+    conditional requests and skip genes whose data did not change,
+    entries of a gene are only kept once the gene is written
+    '''
+    unchanged = object()  # stands in for the payload of an unchanged file
+
+    def __init__(self, out_dir, data_pattern, data_tag):
+        prefix = data_pattern if data_pattern != '' else 'whole_extract'
+        data_tag = '+'.join(SplitDataTags(data_tag))
+        self.path = os.path.join(out_dir, f'{prefix}_{data_tag}_refresh.json')  # noqa
+        self.changed_path = os.path.join(out_dir, f'{prefix}_{data_tag}_changed_genes.txt')  # noqa
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as r_file:
+                    self.entries = json.load(r_file)
+            except (OSError, ValueError) as e:
+                logger.warning(f'Refresh state {self.path} cannot be read, all genes are fetched again: {e}')  # noqa
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def Headers(self, gene, data_tag):
+        with self._lock:
+            entry = self.entries.get(f'{gene}.{data_tag}', {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def Check(self, gene, data_tag, response, content):
+        '''
+        remember validators and hash of a response (200 or 304),
+        returns True if the file did not change since the last run
+        '''
+        key = f'{gene}.{data_tag}'
+        with self._lock:
+            entry = self.entries.get(key)
+        if response.status_code == 304:
+            if entry is None:
+                raise RuntimeError(f'STEP2 - server reports data of gene {gene} as unchanged, but it was never fetched')  # noqa
+            new_entry = dict(entry)
+            new_entry['etag'] = response.headers.get('ETag', entry.get('etag'))  # noqa
+            new_entry['last_modified'] = response.headers.get('Last-Modified', entry.get('last_modified'))  # noqa
+            unchanged = True
+        else:
+            digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            new_entry = {'etag': response.headers.get('ETag'),
+                         'last_modified': response.headers.get('Last-Modified'),  # noqa
+                         'sha256': digest}
+            unchanged = entry is not None and entry.get('sha256') == digest
+        with self._lock:
+            self._pending.setdefault(gene, {})[key] = new_entry
+        return unchanged
+
+    def Commit(self, gene):
+        with self._lock:
+            self.entries.update(self._pending.pop(gene, {}))
+
+    def Discard(self, gene):
+        with self._lock:
+            self._pending.pop(gene, None)
+
+    def Save(self, changed_genes):
+        '''
+        store the entries of all written genes and list the changed ones
+        '''
+        with self._lock:
+            entries = dict(self.entries)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as w_file:
+            json.dump(entries, w_file)
+        os.replace(tmp_path, self.path)
+        with open(self.changed_path, 'w', encoding='utf-8') as w_file:
+            w_file.writelines(f'{gene}\n' for gene in changed_genes)
+
+
+def FetchGeneContent(gene, session, db_url, data_tags, limiter,
+                     cache=None, cache_only=False, metrics=None,
+                     optimistic=False, refresh=None):
+    '''
+    run step 1 and step 2 for one gene in a worker thread,
+    one pre-search precedes the fetch of all data tags of the same gene,
+    returns {data_tag: payload}, cached payloads are not fetched again
+    and skip the pre-search once all tags are cached;
+    optimistic mode first tries the result files directly and only
+    pre-searches if one is missing or incomplete;
+    with a RefreshState requests are conditional and files unchanged
+    since the last run come back as None
+    '''
+    contents = {}
+    for data_tag in data_tags:
+        if cache is None or refresh is not None:
+            break  # a refresh always asks the server
+        content = ReadCache(cache, f'{db_url}user/{gene}.{data_tag}', gene)
+        if metrics is not None:
+            metrics.Inc('cache_hits' if content is not None else 'cache_misses')  # noqa
+        if content is not None:
+            contents[data_tag] = content
+    missing_tags = [data_tag for data_tag in data_tags if data_tag not in contents]  # noqa
+    if len(missing_tags) == 0:
+        gene_logger.info('Payload for gene %s is served from cache (1/4, 2/4)', gene)  # noqa
+        return contents
+    if cache_only:
+        raise RuntimeError(f'STEP2 - data for gene {gene} is not in payload cache (cache-only mode)')  # noqa
+    if optimistic:
+        # result files often still exist on the server from an earlier search
+        with StageTimer(metrics, 'fetch', gene) as record:
+            for data_tag in missing_tags:
+                with limiter.Slot(db_url):
+                    content = FetchGeneData(session=session,
+                                            gene=gene,
+                                            db_url=db_url,
+                                            data_tag=data_tag,
+                                            missing_ok=True,
+                                            refresh=refresh)
+                if content is None:
+                    break
+                if content is not RefreshState.unchanged:
+                    if not IsCompletePayload(data_tag, content):
+                        break
+                    record['bytes'] += len(content)
+                    if cache is not None:
+                        WriteCache(cache, f'{db_url}user/{gene}.{data_tag}', content, gene)  # noqa
+                contents[data_tag] = content
+        missing_tags = [data_tag for data_tag in data_tags if data_tag not in contents]  # noqa
+        if metrics is not None:
+            metrics.Inc('fast_path_misses' if missing_tags else 'fast_path_hits')  # noqa
+        if len(missing_tags) == 0:
+            gene_logger.info('Result files of gene %s are fetched without pre-search (1/4)', gene)  # noqa
+            return {data_tag: None if contents[data_tag] is RefreshState.unchanged else contents[data_tag] for data_tag in data_tags}  # noqa
+        gene_logger.info('Result files of gene %s are missing, falling back to pre-search', gene)  # noqa
+    with limiter.Slot(db_url), StageTimer(metrics, 'presearch', gene):
+        session = ConductPreSearch(gene=gene,
+                                   session=session,
+                                   db_url=db_url)
+    # the pooled session keeps the connection of the pre-search alive
+    with StageTimer(metrics, 'fetch', gene) as record:
+        for data_tag in missing_tags:
+            with limiter.Slot(db_url):
+                content = FetchGeneData(session=session,
+                                        gene=gene,
+                                        db_url=db_url,
+                                        data_tag=data_tag,
+                                        refresh=refresh)
+            if content is not RefreshState.unchanged:
+                record['bytes'] += len(content)
+                if cache is not None and content:
+                    WriteCache(cache, f'{db_url}user/{gene}.{data_tag}', content, gene)  # noqa
+            contents[data_tag] = content
+    return {data_tag: None if contents[data_tag] is RefreshState.unchanged else contents[data_tag] for data_tag in data_tags}  # noqa
+
+
+def IterFetchedGenes(genes, session, db_url, data_tags, workers, max_per_host,
+                     cache=None, cache_only=False, metrics=None, window=0,
+                     optimistic=False, refresh=None):
+    '''
+    fetch genes concurrently and yield (gene, future) in input order,
+    at most window (default workers * 4) genes are pending at any time
+    so payloads do not pile up in memory
+    '''
+    if workers < 1:
+        raise ValueError(f'Number of workers must be at least 1, but got {workers}!')  # noqa
+    window_size = window if window > 0 else workers * 4
+    limiter = HostRequestLimiter(max_per_host)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for gene in genes:
+            future = executor.submit(FetchGeneContent, gene, session,
+                                     db_url, data_tags, limiter,
+                                     cache, cache_only, metrics,
+                                     optimistic, refresh)
+            window.append((gene, future))
+            if len(window) >= window_size:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+
+class PatternMatcher:
+    '''
+    match treatment_project labels against all patterns at once,
+    a compiled case-insensitive alternation rejects non-matching labels
+    in one scan and the pattern indices of every label are memoized,
+    since the same treatment_project labels come back for every gene
+    '''
+    overlap_modes = ('duplicate', 'first')
+
+    def __init__(self, pattern_list, overlap='duplicate'):
+        if overlap not in self.overlap_modes:
+            raise ValueError(f'Pattern overlap mode can only be either duplicate or first, but got {overlap}!')  # noqa
+        self.pattern_list = pattern_list
+        self.overlap = overlap
+        self._lower_patterns = [pattern.lower() for pattern in pattern_list]
+        self._regex = re.compile('|'.join(re.escape(pattern) for pattern in pattern_list), re.IGNORECASE)  # noqa
+        self._memo = {}
+
+    def Match(self, treatment):
+        '''
+        indices of patterns found in treatment, in pattern_list order,
+        only the first one if overlap mode is first
+        '''
+        indices = self._memo.get(treatment)
+        if indices is None:
+            indices = ()
+            if self._regex.search(treatment) is not None:
+                lower_treatment = treatment.lower()
+                indices = tuple(k for k, pattern in enumerate(self._lower_patterns) if pattern in lower_treatment)  # noqa
+                if self.overlap == 'first':
+                    indices = indices[:1]
+            self._memo[treatment] = indices
+        return indices
+
+
+@lru_cache(maxsize=16)
+def CompilePatterns(data_pattern, overlap='duplicate'):
+    '''
+    split '_'-joined data_pattern into a PatternMatcher,
+    None if pattern mode is off
+    '''
+    if data_pattern == '':
+        return None  # pattern mode off
+    pattern_list = [pattern for pattern in data_pattern.split('_') if pattern != '']  # noqa
+    if len(pattern_list) == 0:
+        return None
+    return PatternMatcher(pattern_list, overlap)
+
+
+def PayloadCells(content):
+    '''
+    cells of a tbox payload, 21 for a complete one: a header row
+    followed by one row of up- and one of down-regulated data, 7 each
+    '''
+    rep_dict = {'\nup': ',up',
+                '\ndown': ',down',
+                '\n': ''}
+    for k, v in rep_dict.items():  # replace ununiform format in the dataset for further data processing # noqa
+        content = content.replace(k, v)
+    return content.split(',')
+
+
+def IsCompletePayload(data_tag, content):
+    '''
+    cheap check whether a fetched payload can be used as it is
+    '''
+    if content.strip() == '':
+        return False
+    if data_tag == 'tbox':
+        return len(PayloadCells(content)) == 21
+    return True
+
+
+def ParseFloatElement(element):
+    try:
+        return float(element)
+    except ValueError:
+        return np.nan
+
+
+def ParseFloatCell(gene, cell, min_count):
+    '''
+    decode a ';'-joined numeric cell straight into a float32 array
+    without building a list of strings first, a cell with malformed
+    elements (e.g. NA) is parsed element by element instead and those
+    elements become NaN, as missing values
+    '''
+    try:
+        values = np.fromstring(cell, dtype=np.float32, sep=';')
+    except ValueError:
+        values = None  # numpy 2 raises on a malformed element
+    # numpy 1 stops reading at a malformed element instead
+    if values is None or len(values) != cell.count(';') + 1:
+        values = np.array([ParseFloatElement(element) for element in cell.split(';')], dtype=np.float32)  # noqa
+        logger.warning(f'Malformed numbers in results of gene {gene} are treated as missing values')  # noqa
+    if len(values) < min_count:
+        raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')  # noqa
+    return values
+
+
+def EmptyBlockColumns(title, n, conditions):
+    '''
+    (column, dtype) ParsePayloadColumns gives schema field n
+    '''
+    if n == 1:
+        return [(title, pd.StringDtype())]
+    if n == 5:
+        return [(title, pd.Float32Dtype())]
+    dtype = pd.StringDtype() if n == 6 else pd.Float32Dtype()
+    return [(f'{title}_{condition}', dtype) for condition in conditions]
+
+
+def ParsePayloadColumns(gene, content):
+    '''
+    split the 21-cell payload once into output columns,
+    numeric cells become float32 arrays with the mock / treated halves
+    as views of one array, treatment labels are interned since the same
+    ones come back for every gene,
+    returns {'up': {column: values}, 'down': {column: values}}
+    and the dtype of each column
+    '''
     conditions = ('mock', 'treated')
     schema = asdict(ResultsDataFrameParams())
-    results = {}
-    results_dtype = {}
-    logger.info(f'Results formatting for gene {gene} is started (3/4)')
-    if content is None:
-        logger.warning(f'Results formatting step for gene {gene} is skipped since no data was retrieved from db.')  # noqa
-        raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')
-    else:
-        rep_dict = {'\nup': ',up',
-                    '\ndown': ',down',
-                    '\n': ''}
-        for k, v in rep_dict.items():  # replace ununiform format in the dataset for further data processing # noqa
-            content = content.replace(k, v)
-    items = content.split(',')
+    items = PayloadCells(content)
     if len(items) != 21:
         logger.warning(f'Results formatting step for gene {gene} is skipped since data retrieved is incomplete and has {len(items)} cells!')  # noqa
         raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')  # noqa
-    if data_pattern == '':
-        pass  # pattern mode off
-    else:
-        if '_' in data_pattern:  # pattern mode on
-            pattern_list = data_pattern.split('_')  # multi-pattern mode
-        else:
-            pattern_list.append(data_pattern)  # single pattern mode
-    if len(pattern_list) == 0:
+    blocks = {}
+    columns_dtype = {}
+    for b, regulation in enumerate(('up', 'down')):
+        block = {}
+        offset = (b + 1) * len(schema)  # row 2 holds up-, row 3 down-regulated data # noqa
+        # an empty treatment cell means no treatment of this regulation
+        labels = items[offset + 1].split(';') if items[offset + 1] != '' else []  # noqa
+        len_elements = len(labels)
         for n, title in enumerate(schema):
-            column = title
-            idx_row_up = n + len(schema)
-            idx_row_down = n + (2 * len(schema))
-            items_up = items[idx_row_up]
-            items_down = items[idx_row_down]
-            if n in [1, 5]:
-                elements_up = items_up.split(';')
-                elements_down = items_down.split(';')
-                len_elements_up = len(elements_up)
-                len_elements_down = len(elements_down)
-                elements = elements_up + elements_down
-                results[column] = elements
-                results_dtype[column] = pd.StringDtype() if n == 1 else pd.Float32Dtype()
-            elif n in [2, 4, 6]:
-                items_up = items_up.replace('_', ';')
-                items_down = items_down.replace('_', ';')
-                elements_up = items_up.split(';')
-                elements_down = items_down.split(';')
-                for m, condition in enumerate(conditions):
-                    column = f'{title}_{condition}'
-                    elements_up_col = elements_up[m * len_elements_up:(m + 1) * len_elements_up]
-                    elements_down_col = elements_down[m * len_elements_down:(m + 1) * len_elements_down]
-                    elements = elements_up_col + elements_down_col
-                    results[column] = elements
-                    results_dtype[column] = pd.StringDtype() if n == 6 else pd.Float32Dtype()
-    else:
-        up_treatment = items[8]  # cell 8 contains treatment_project info for up-regulated expression data # noqa
-        up_treat_items = up_treatment.split(';')
-        down_treatment = items[15]  # cell 15 for down-regulated expression data # noqa
-        down_treat_items = down_treatment.split(';')
-        kw_sum = []
-        gene_sum = []
-        for pattern in pattern_list:
-            up_extract = [pattern.lower() in item.lower() for item in up_treat_items]  # noqa
-            down_extract = [pattern.lower() in item.lower() for item in down_treat_items]  # noqa
-            for n, title in enumerate(schema):
-                column = title
-                idx_row_up = n + len(schema)
-                idx_row_down = n + (2 * len(schema))
-                items_up = items[idx_row_up]
-                items_down = items[idx_row_down]
-                if n in [1, 5]:
-                    elements_up = items_up.split(';')
-                    elements_down = items_down.split(';')
-                    if len(elements_up) != len(up_extract):
-                        logger.error(f'length of up-regulated treatment is NOT equal to that of {title} for gene {gene}')  # noqa
-                        raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')
-                    if len(elements_down) != len(down_extract):
-                        logger.error(f'length of down-regulated treatment is NOT equal to that of {title} for gene {gene}')
+            cell = items[offset + n]
+            try:
+                if len_elements == 0 and n in [1, 2, 4, 5, 6]:
+                    # nothing to parse, only the (empty) columns are set up
+                    for column, dtype in EmptyBlockColumns(title, n, conditions):  # noqa
+                        block[column] = np.empty(0, dtype=np.float32) if dtype == pd.Float32Dtype() else []  # noqa
+                        columns_dtype[column] = dtype
+                elif n == 1:
+                    block[title] = [sys.intern(label) for label in labels]
+                    columns_dtype[title] = pd.StringDtype()
+                elif n == 5:
+                    block[title] = ParseFloatCell(gene, cell, len_elements)
+                    if len(block[title]) != len_elements:
+                        raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')  # noqa
+                    columns_dtype[title] = pd.Float32Dtype()
+                elif n in [2, 4]:
+                    # mock and treated values are joined by '_', one array for both # noqa
+                    values = ParseFloatCell(gene, cell.replace('_', ';'), len(conditions) * len_elements)  # noqa
+                    for m, condition in enumerate(conditions):
+                        column = f'{title}_{condition}'
+                        block[column] = values[m * len_elements:(m + 1) * len_elements]  # noqa
+                        columns_dtype[column] = pd.Float32Dtype()
+                elif n == 6:
+                    elements = cell.replace('_', ';').split(';')
+                    if len(elements) < len(conditions) * len_elements:
                         raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')  # noqa
-                    if n == 1:
-                        len_elements_up = len(elements_up)
-                        len_elements_down = len(elements_down)
-                    up_extract_items = [item for item, flag in zip(elements_up, up_extract) if flag]  # noqa
-                    down_extract_items = [item for item, flag in zip(elements_down, down_extract) if flag]  # noqa
-                    extract_items = up_extract_items + down_extract_items
-                    if n == 1:
-                        extract_items_len = len(extract_items)
-                        gene_col = [gene] * extract_items_len
-                        gene_sum = gene_sum + gene_col
-                        kw_col = [pattern] * extract_items_len
-                        kw_sum = kw_sum + kw_col
-                    if column in results.keys():
-                        for it in extract_items:
-                            results[column].append(it)
-                    else:
-                        results[column] = extract_items
-                        results_dtype[column] = pd.StringDtype() if n == 1 else pd.Float32Dtype()
-                elif n in [2, 4, 6]:
-                    items_up = items_up.replace('_', ';')
-                    items_down = items_down.replace('_', ';')
-                    elements_up = items_up.split(';')
-                    elements_down = items_down.split(';')
                     for m, condition in enumerate(conditions):
                         column = f'{title}_{condition}'
-                        elements_up_col = elements_up[m * len_elements_up:(m + 1) * len_elements_up]
-                        elements_down_col = elements_down[m * len_elements_down:(m + 1) * len_elements_down]
-                        if len(elements_up_col) != len(up_extract):
-                            logger.error(f'length of up-regulated treatment in {condition} is NOT equal to that of {title} for gene {gene}')
-                            raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')
-                        if len(elements_down_col) != len(down_extract):
-                            logger.error(f'length of down-regulated treatment in {condition} is NOT equal to that of {title} for gene {gene}')
-                            raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')
-                        up_extract_items = [item for item, flag in zip(elements_up_col,up_extract) if flag]
-                        down_extract_items = [item for item, flag in zip(elements_down_col,down_extract) if flag]
-                        extract_items = up_extract_items + down_extract_items
-                        if column in results.keys():
-                            for item in extract_items:
-                                results[column].append(item)
-                        else:
-                            results[column] = extract_items
-                            results_dtype[column] = pd.StringDtype() if n == 6 else pd.Float32Dtype()
-        results['keyword'] = kw_sum
-        results['gene'] = gene_sum
-        up_extract = []
-        down_extract = []
-    logger.info(f'Results formatting for gene {gene} is finished (3/4)')
+                        block[column] = elements[m * len_elements:(m + 1) * len_elements]  # noqa
+                        columns_dtype[column] = pd.StringDtype()
+            except ValueError:
+                logger.error(f'length of {regulation}-regulated treatment is NOT equal to that of {title} for gene {gene}')  # noqa
+                raise
+        blocks[regulation] = block
+    return blocks, columns_dtype
+
+
+def ConcatValues(chunks):
+    '''
+    join column chunks, float32 arrays or lists of str
+    '''
+    if len(chunks) > 0 and isinstance(chunks[0], np.ndarray):
+        return np.concatenate(chunks)
+    return [value for chunk in chunks for value in chunk]
+
+
+def SelectPatternRows(gene, results, matcher):
+    '''
+    rows of whole extract results matching the patterns of matcher,
+    grouped by pattern (in given order) with the row order kept within
+    each pattern, so up- come before down-regulated rows; a row matching
+    several patterns is repeated unless the overlap mode is 'first'
+    '''
+    selected = [[] for _ in matcher.pattern_list]
+    for i, treatment in enumerate(results['treatment_project']):
+        for k in matcher.Match(treatment):
+            selected[k].append(i)
+    rows = [i for indices in selected for i in indices]
+    index = np.asarray(rows, dtype=np.intp)
+    # one gather per column instead of element-wise appends
+    selected_results = {column: values[index] if isinstance(values, np.ndarray) else [values[i] for i in rows]  # noqa
+                        for column, values in results.items()}
+    selected_results['keyword'] = [pattern for pattern, indices in zip(matcher.pattern_list, selected) for _ in indices]  # noqa
+    selected_results['gene'] = [gene] * len(rows)
+    return selected_results
+
+
+def FormatRawDataFromDb(gene, content, data_pattern, pattern_overlap='duplicate',  # noqa
+                        with_regulation=False):
+    '''
+    format one payload into output columns, in pattern mode rows are
+    grouped by pattern (in given order) and then by regulation, a row
+    matching several patterns is repeated for each of them unless
+    pattern_overlap is 'first'; with_regulation adds a leading
+    regulation column (up / down)
+    '''
+    gene_logger.info('Results formatting for gene %s is started (3/4)', gene)
+    if content is None:
+        logger.warning(f'Results formatting step for gene {gene} is skipped since no data was retrieved from db.')  # noqa
+        raise ValueError(f'STEP 3 - Results formatting for gene {gene} failed')
+    blocks, results_dtype = ParsePayloadColumns(gene, content)
+    up, down = blocks['up'], blocks['down']
+    results = {column: ConcatValues([up[column], down[column]]) for column in results_dtype}  # noqa
+    if with_regulation:
+        regulation = ['up'] * len(up['treatment_project']) + ['down'] * len(down['treatment_project'])  # noqa
+        results = {'regulation': regulation, **results}
+        results_dtype = {'regulation': pd.StringDtype(), **results_dtype}
+    matcher = CompilePatterns(data_pattern, pattern_overlap)
+    if matcher is not None:
+        results = SelectPatternRows(gene, results, matcher)
+    gene_logger.info('Results formatting for gene %s is finished (3/4)', gene)
     return results, results_dtype
 
 
-def WriteFormattedResults(results, dtype, data_pattern, gene):
-    logger.info(f'Formatted results writing for gene {gene} is started (4/4)')
-    file_name = f'{QueryMetaData.out_dir}/{data_pattern}_RNAseq_data.csv' if data_pattern != '' else f'{QueryMetaData.out_dir}/{gene}_RNAseq_data.csv'
-    pd_df_results = pd.DataFrame(results)
-    copy = pd_df_results.astype(dtype=dtype, copy=True)
-    if os.path.exists(file_name):
-        csv = copy.to_csv(index=False, header=False)
-    else:
-        csv = copy.to_csv(index=False)
+# parser of each data tag, payloads of other tags are written as they are
+tag_parsers = {'tbox': FormatRawDataFromDb}
+
+
+def FormatPayloads(gene, contents, data_pattern, pattern_overlap='duplicate',
+                   with_regulation=False):
+    '''
+    step 3 for all data tags of one gene, returns {data_tag: (results, dtype)}
+    for tags with a parser and {data_tag: payload} for the others,
+    unchanged payloads (None) stay None
+    '''
+    formatted = {}
+    for data_tag, content in contents.items():
+        parser = tag_parsers.get(data_tag)
+        if parser is None or content is None:
+            formatted[data_tag] = content
+            continue
+        formatted[data_tag] = parser(gene=gene,
+                                     content=content,
+                                     data_pattern=data_pattern,
+                                     pattern_overlap=pattern_overlap,
+                                     with_regulation=with_regulation)
+    return formatted
+
+
+def DropRegulation(results, dtype):
+    '''
+    rows formatted with_regulation as the output files get them
+    '''
+    results = {column: values for column, values in results.items() if column != 'regulation'}  # noqa
+    dtype = {column: value for column, value in dtype.items() if column != 'regulation'}  # noqa
+    return results, dtype
+
+
+def OutputFileName(out_dir, data_pattern, gene, out_format='csv'):
+    '''
+    in pattern mode columnar formats are written as a dataset directory
+    of part files, one part per batch
+    '''
+    if data_pattern != '':
+        return os.path.join(out_dir, f'{data_pattern}_RNAseq_data.{out_format}')  # noqa
+    return os.path.join(out_dir, f'{gene}_RNAseq_data.{out_format}')
+
+
+class RunJournal:
+    '''
+    append-only checkpoint journal in out_dir,
+    each written gene is committed with the byte offset its output file
+    reached, rows beyond the last committed offset are truncated on resume
+    '''
+    def __init__(self, out_dir, data_pattern, data_tag, resume=False):
+        self.path = self.PathFor(out_dir, data_pattern, data_tag)
+        self.done_genes = set()
+        self.failed_genes = {}
+        self.offsets = {}
+        if resume and os.path.exists(self.path):
+            self.done_genes, self.failed_genes, self.offsets = ReadJournal(self.path)  # noqa
+            self._Rollback()
+            mode = 'a'
+        else:
+            mode = 'w'
+        self._file = open(self.path, mode, encoding='utf-8')
+
+    @staticmethod
+    def PathFor(out_dir, data_pattern, data_tag):
+        prefix = data_pattern if data_pattern != '' else 'whole_extract'
+        data_tag = '+'.join(SplitDataTags(data_tag))
+        return os.path.join(out_dir, f'{prefix}_{data_tag}_journal.jsonl')
+
+    def _Rollback(self):
+        for file_name, offset in list(self.offsets.items()):
+            if os.path.isdir(file_name):
+                # dataset directory, part files never committed are dropped
+                for root, _, names in os.walk(file_name):
+                    for name in names:
+                        part_file = os.path.join(root, name)
+                        if part_file not in self.offsets:
+                            logger.warning(f'Uncommitted part file {part_file} is dropped')  # noqa
+                            os.remove(part_file)
+                continue
+            if not file_name.endswith('.csv') or not os.path.exists(file_name):  # noqa
+                continue  # columnar files are only ever replaced as a whole
+            if os.path.getsize(file_name) > offset:
+                logger.warning(f'Uncommitted rows beyond offset {offset} in {file_name} are dropped')  # noqa
+                with open(file_name, 'r+b') as t_file:
+                    t_file.truncate(offset)
+
+    def _Append(self, record, sync=False):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def Begin(self, file_name):
+        '''
+        remember the committed size of an output file before its first write,
+        or the part files a dataset directory already holds
+        '''
+        if file_name in self.offsets:
+            return
+        if os.path.isdir(file_name):
+            for root, _, names in os.walk(file_name):
+                for name in names:
+                    part_file = os.path.join(root, name)
+                    self.offsets[part_file] = os.path.getsize(part_file)
+                    self._Append({'stage': 'part', 'file': part_file, 'offset': self.offsets[part_file]})  # noqa
+            offset = 0
+        else:
+            offset = os.path.getsize(file_name) if os.path.exists(file_name) else 0  # noqa
+        self.offsets[file_name] = offset
+        self._Append({'stage': 'begin', 'file': file_name, 'offset': offset}, sync=True)  # noqa
+
+    def Commit(self, genes, offsets):
+        '''
+        mark genes as written once their rows are on disk,
+        offsets maps each file written for them to its committed size,
+        its last entry is the output file genes are recorded against
+        '''
+        *part_files, file_name = offsets
+        for part_file in part_files:
+            self.offsets[part_file] = offsets[part_file]
+            self._file.write(json.dumps({'stage': 'part', 'file': part_file, 'offset': offsets[part_file]}) + '\n')  # noqa
+        offset = offsets[file_name]
+        self.offsets[file_name] = offset
+        for gene in genes:
+            self.done_genes.add(gene)
+            self.failed_genes.pop(gene, None)
+            self._file.write(json.dumps({'stage': 'written', 'gene': gene, 'file': file_name, 'offset': offset}) + '\n')  # noqa
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def Fail(self, gene, reason):
+        self.failed_genes[gene] = str(reason)
+        self._Append({'stage': 'failed', 'gene': gene, 'reason': str(reason)})  # noqa
+
+    def Close(self):
+        self._file.close()
+
+
+def ReadJournal(path):
+    '''
+    replay a run journal, returns (done_genes, failed_genes, offsets)
+    '''
+    done_genes = set()
+    failed_genes = {}
+    offsets = {}
+    with open(path, 'r', encoding='utf-8') as r_file:
+        for line in r_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # torn last line of a crashed run
+            stage = record['stage']
+            if stage in ['begin', 'part', 'written']:
+                offsets[record['file']] = record['offset']
+            if stage == 'written':
+                done_genes.add(record['gene'])
+                failed_genes.pop(record['gene'], None)
+            elif stage == 'failed':
+                failed_genes[record['gene']] = record['reason']
+    return done_genes, failed_genes, offsets
+
+
+def InitParseWorker(log_file, gene_log_sample=1):
+    '''
+    set up logging in a parse worker process, needed where processes
+    are spawned instead of forked (e.g. macOS)
+    '''
+    if log_file is not None and len(logging.getLogger().handlers) == 0:
+        logging.basicConfig(filename=log_file,
+                            format='%(asctime)s - **%(levelname)s**: %(message)s',  # noqa
+                            level=logging.INFO)
+    if gene_log_sample == 0:
+        gene_logger.setLevel(logging.WARNING)
+    elif gene_log_sample > 1 and len(gene_logger.filters) == 0:
+        gene_logger.addFilter(GeneLogSampler(gene_log_sample))
+
+
+def FormatInWorker(gene, contents, data_pattern, pattern_overlap,
+                   with_regulation=False):
+    '''
+    step 3 in a parse worker process,
+    returns formatted payloads plus wall time and input bytes for metrics
+    '''
+    start = time.perf_counter()
+    formatted = FormatPayloads(gene=gene,
+                               contents=contents,
+                               data_pattern=data_pattern,
+                               pattern_overlap=pattern_overlap,
+                               with_regulation=with_regulation)
+    n_bytes = sum(len(content) for content in contents.values() if content is not None)  # noqa
+    return formatted, time.perf_counter() - start, n_bytes
+
+
+def ChainParse(fetch_future, parse_pool, gene, data_pattern, pattern_overlap,
+               with_regulation=False):
+    '''
+    hand a payload to the parse pool as soon as its fetch is done,
+    returns a future of FormatInWorker's result
+    '''
+    parse_future = Future()
+
+    def OnParsed(done):
+        try:
+            parse_future.set_result(done.result())
+        except Exception as e:
+            parse_future.set_exception(e)
+
+    def OnFetched(done):
+        try:
+            submitted = parse_pool.submit(FormatInWorker, gene, done.result(),
+                                          data_pattern, pattern_overlap,
+                                          with_regulation)
+        except Exception as e:
+            parse_future.set_exception(e)
+            return
+        submitted.add_done_callback(OnParsed)
+
+    fetch_future.add_done_callback(OnFetched)
+    return parse_future
+
+
+def IterParsedGenes(fetched, parse_pool, data_pattern, pattern_overlap, window,  # noqa
+                    with_regulation=False):
+    '''
+    second pipeline stage: format payloads in a process pool while
+    further genes are fetched, yield (gene, future) in input order,
+    at most window genes wait between fetching and writing
+    '''
+    queue = deque()
+    for gene, fetch_future in fetched:
+        queue.append((gene, ChainParse(fetch_future, parse_pool, gene,
+                                       data_pattern, pattern_overlap,
+                                       with_regulation)))
+        if len(queue) >= window:
+            yield queue.popleft()
+    while queue:
+        yield queue.popleft()
+
+
+def ResultsToDataFrame(results, dtype, categorical_columns=()):
+    '''
+    build a typed DataFrame from formatted results columns,
+    given string columns are turned into categoricals
+    '''
+    df_results = pd.DataFrame(results).astype(dtype=dtype)
+    for column in categorical_columns:
+        if column in df_results.columns:
+            df_results[column] = df_results[column].astype('category')
+    return df_results
+
+
+class ResultsWriter:
+    '''
+    buffer formatted results of several genes and write them in batches,
+    one open file handle per output file and one dtype conversion per batch,
+    in whole extract mode every gene has its own file which is written
+    and closed right away
+    '''
+    out_formats = ('csv', 'parquet', 'feather')
+    # low-cardinality string columns, dictionary-encoded in columnar output
+    categorical_columns = ('treatment_project', 'experiment', 'regulation', 'keyword', 'gene')  # noqa
+
+    def __init__(self, out_dir, data_pattern, journal=None,
+                 batch_rows=10000, batch_mb=8, out_format='csv',
+                 partition_by_keyword=False, metrics=None, replace=False):
+        if batch_rows < 1:
+            raise ValueError(f'Batch size in rows must be at least 1, but got {batch_rows}!')  # noqa
+        if batch_mb <= 0:
+            raise ValueError(f'Batch size in MB must be positive, but got {batch_mb}!')  # noqa
+        self.out_dir = out_dir
+        self.data_pattern = data_pattern
+        self.journal = journal
+        self.batch_rows = batch_rows
+        self.batch_bytes = int(batch_mb * 1024 * 1024)
+        if out_format not in self.out_formats:
+            raise ValueError(f'Output format can only be either csv, parquet or feather, but got {out_format}!')  # noqa
+        if partition_by_keyword and (out_format == 'csv' or data_pattern == ''):  # noqa
+            raise ValueError('Partitioning by keyword needs parquet or feather output and a data pattern!')  # noqa
+        self.out_format = out_format
+        self.partition_by_keyword = partition_by_keyword
+        self.metrics = metrics
+        if out_format != 'csv':
+            try:
+                import pyarrow
+                import pyarrow.compute
+                import pyarrow.feather
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError(f'Writing {out_format} output needs pyarrow, please install it first, e.g. "pip install pyarrow"') from e  # noqa
+            self._pa = pyarrow
+        self._run_id = f'{int(time.time() * 1000):x}'
+        self._part_count = 0
+        self._handles = {}
+        self._buffers = {}
+        self.closed = False
+        # with replace, rows written for a gene supersede what earlier runs
+        # wrote for it, in pattern mode those rows are dropped on Close
+        self.replace = replace
+        self._replaced_genes = set()
+        self._earlier_output = None
+        if replace and data_pattern != '':
+            file_name = OutputFileName(out_dir, data_pattern, '', out_format)
+            if os.path.isdir(file_name):
+                self._earlier_output = {os.path.join(root, name) for root, _, names in os.walk(file_name) for name in names}  # noqa
+            elif os.path.exists(file_name):
+                self._earlier_output = os.path.getsize(file_name)
+
+    def Add(self, gene, results, dtype):
+        '''
+        buffer results of one gene, returns [(gene, error)] of every gene
+        whose batch got written (error None) or failed by this call
+        '''
+        file_name = OutputFileName(self.out_dir, self.data_pattern, gene, self.out_format)  # noqa
+        buffer = self._buffers.setdefault(file_name, {'genes': [], 'columns': {}, 'dtype': dtype, 'rows': 0, 'bytes': 0})  # noqa
+        buffer['genes'].append(gene)
+        if self.replace:
+            self._replaced_genes.add(gene)
+        for column, values in results.items():
+            buffer['columns'].setdefault(column, []).append(values)
+            buffer['bytes'] += values.nbytes if isinstance(values, np.ndarray) else sum(len(value) + 1 for value in values)  # noqa
+        buffer['rows'] += len(next(iter(results.values()), []))
+        if self.data_pattern == '':
+            outcomes = self.Flush(file_name)
+            self._CloseHandle(file_name)
+            return outcomes
+        if buffer['rows'] >= self.batch_rows or buffer['bytes'] >= self.batch_bytes:  # noqa
+            return self.Flush(file_name)
+        return []
+
+    def Flush(self, file_name):
+        buffer = self._buffers.pop(file_name, None)
+        if buffer is None:
+            return []
+        genes = buffer['genes']
+        buffer['columns'] = {column: ConcatValues(chunks) for column, chunks in buffer['columns'].items()}  # noqa
+        logger.info('Formatted results writing for %d genes is started (4/4)', len(genes))  # noqa
+        try:
+            with StageTimer(self.metrics, 'write', genes) as record:
+                if self.out_format != 'csv':
+                    record['bytes'] = self._WriteColumnar(file_name, genes, buffer)  # noqa
+                else:
+                    record['bytes'] = self._WriteCsv(file_name, genes, buffer)
+        except Exception as e:
+            logger.error(f'Error occured when writing formatted results into given path: {e}')  # noqa
+            error = RuntimeError(f'STEP 4 - results writing for {len(genes)} genes failed: {e}')  # noqa
+            return [(gene, error) for gene in genes]
+        logger.info('Formatted results writing for %d genes is finished (4/4)', len(genes))  # noqa
+        return [(gene, None) for gene in genes]
+
+    def _WriteCsv(self, file_name, genes, buffer):
+        '''
+        append one batch to the csv file, returns bytes written
+        '''
+        if self.journal is not None:
+            self.journal.Begin(file_name)
+        w_file = self._handles.get(file_name)
+        if w_file is None:
+            # whole extract files only hold one gene, replacing means rewriting
+            w_file = open(file_name, 'wb' if self.replace and self.data_pattern == '' else 'ab')  # noqa
+            self._handles[file_name] = w_file
+        df_results = ResultsToDataFrame(buffer['columns'], buffer['dtype'])
+        csv = df_results.to_csv(index=False, header=w_file.tell() == 0).encode('utf-8')  # noqa
+        logger.info('Trying to write formatted results in csv file with path %s', file_name)  # noqa
+        w_file.write(csv)
+        w_file.flush()
+        if self.journal is not None:
+            os.fsync(w_file.fileno())
+            self.journal.Commit(genes, {file_name: w_file.tell()})
+        return len(csv)
+
+    def _WriteColumnar(self, file_name, genes, buffer):
+        '''
+        write one batch as parquet / feather, every file is written
+        under a temporary name and renamed once complete,
+        returns bytes written
+        '''
+        df_results = ResultsToDataFrame(buffer['columns'], buffer['dtype'],
+                                        self.categorical_columns)
+        if self.data_pattern == '':
+            parts = [(file_name, df_results)]  # one file per gene
+        else:
+            if not os.path.isdir(file_name):
+                os.makedirs(file_name)
+            if self.journal is not None:
+                self.journal.Begin(file_name)
+            part_name = f'part-{self._run_id}-{self._part_count:05d}.{self.out_format}'  # noqa
+            self._part_count += 1
+            if self.partition_by_keyword:
+                parts = [(os.path.join(file_name, f'keyword={keyword}', part_name),  # noqa
+                          group.drop(columns='keyword'))
+                         for keyword, group in df_results.groupby('keyword', sort=False, observed=True)]  # noqa
+            else:
+                parts = [(os.path.join(file_name, part_name), df_results)]
+        offsets = {}
+        for part_file, df_part in parts:
+            os.makedirs(os.path.dirname(part_file), exist_ok=True)
+            table = self._pa.Table.from_pandas(df_part, preserve_index=False)  # noqa
+            tmp_file = f'{part_file}.tmp'
+            logger.info(f'Trying to write formatted results in {self.out_format} file with path {part_file}')  # noqa
+            if self.out_format == 'parquet':
+                self._pa.parquet.write_table(table, tmp_file)
+            else:
+                self._pa.feather.write_feather(table, tmp_file)
+            os.replace(tmp_file, part_file)
+            offsets[part_file] = os.path.getsize(part_file)
+        if self.journal is not None and len(offsets) > 0:
+            if self.data_pattern != '':
+                offsets[file_name] = 0  # genes are recorded against the dataset directory # noqa
+            self.journal.Commit(genes, offsets)
+        return sum(os.path.getsize(part_file) for part_file, _ in parts)
+
+    def _CloseHandle(self, file_name):
+        w_file = self._handles.pop(file_name, None)
+        if w_file is not None:
+            w_file.close()
+
+    def _ReadPart(self, part_file):
+        if self.out_format == 'parquet':
+            return self._pa.parquet.read_table(part_file)
+        return self._pa.feather.read_table(part_file)
+
+    def _WritePart(self, table, part_file):
+        tmp_file = f'{part_file}.tmp'
+        if self.out_format == 'parquet':
+            self._pa.parquet.write_table(table, tmp_file)
+        else:
+            self._pa.feather.write_feather(table, tmp_file)
+        os.replace(tmp_file, part_file)
+
+    def _ConcatParts(self, tables):
+        '''
+        join tables of different batches, whose dictionary columns may
+        use different dictionaries and index widths
+        '''
+        pa = self._pa
+        decoded = []
+        for table in tables:
+            for i, column in enumerate(table.schema):
+                if pa.types.is_dictionary(column.type):
+                    table = table.set_column(i, column.name, table.column(i).cast(column.type.value_type))  # noqa
+            decoded.append(table)
+        table = pa.concat_tables(decoded)
+        for i, column in enumerate(tables[0].schema):
+            if pa.types.is_dictionary(column.type):
+                table = table.set_column(i, column.name, pa.compute.dictionary_encode(table.column(i)))  # noqa
+        return table.replace_schema_metadata(tables[0].schema.metadata)
+
+    def _DropReplacedRows(self):
+        '''
+        move the rows this run wrote for replaced genes to where earlier
+        runs left their old rows, so the output keeps gene list order;
+        rows of genes not in the earlier output stay at the end
+        '''
+        file_name = OutputFileName(self.out_dir, self.data_pattern, '', self.out_format)  # noqa
+        logger.info(f'Earlier results of {len(self._replaced_genes)} genes are replaced in {file_name}')  # noqa
+        if self.out_format == 'csv':
+            tmp_file = f'{file_name}.tmp'
+            with open(file_name, 'rb') as r_file, open(tmp_file, 'wb') as w_file:  # noqa
+                header = r_file.readline()
+                w_file.write(header)
+                gene_index = header.decode('utf-8').rstrip('\r\n').split(',').index('gene')  # noqa
+                # rows of this run by gene, only their offsets are kept
+                r_file.seek(self._earlier_output)
+                new_rows = {}
+                offset = self._earlier_output
+                for line in r_file:
+                    gene = line.decode('utf-8').rstrip('\r\n').split(',')[gene_index]  # noqa
+                    new_rows.setdefault(gene, []).append((offset, len(line)))
+                    offset += len(line)
+                r_file.seek(len(header))
+                placed = set()
+                while r_file.tell() < self._earlier_output:
+                    line = r_file.readline()
+                    gene = line.decode('utf-8').rstrip('\r\n').split(',')[gene_index]  # noqa
+                    if gene not in self._replaced_genes:
+                        w_file.write(line)
+                    elif gene not in placed:
+                        placed.add(gene)
+                        position = r_file.tell()
+                        for row_offset, length in new_rows.pop(gene, []):
+                            r_file.seek(row_offset)
+                            w_file.write(r_file.read(length))
+                        r_file.seek(position)
+                # genes new to the output
+                for rows in new_rows.values():
+                    for row_offset, length in rows:
+                        r_file.seek(row_offset)
+                        w_file.write(r_file.read(length))
+            os.replace(tmp_file, file_name)
+            return
+        pa = self._pa
+        replaced = pa.array(sorted(self._replaced_genes), type=pa.string())
+        # part files of this run, by directory (keyword partition)
+        new_parts = {}
+        for root, _, names in os.walk(file_name):
+            for name in sorted(names):
+                part_file = os.path.join(root, name)
+                if part_file not in self._earlier_output and name.endswith(f'.{self.out_format}'):  # noqa
+                    new_parts.setdefault(root, []).append(part_file)
+        for root, part_files in new_parts.items():
+            new_table = self._ConcatParts([self._ReadPart(part_file) for part_file in part_files])  # noqa
+            new_genes = new_table.column('gene').cast(pa.string()).to_pylist()
+            new_rows = {}
+            for i, gene in enumerate(new_genes):
+                new_rows.setdefault(gene, []).append(i)
+            placed = set()
+            for part_file in sorted(self._earlier_output):
+                if os.path.dirname(part_file) != root or not os.path.exists(part_file):  # noqa
+                    continue
+                table = self._ReadPart(part_file)
+                genes = table.column('gene').cast(pa.string())
+                if not pa.compute.any(pa.compute.is_in(genes, value_set=replaced)).as_py():  # noqa
+                    continue
+                pieces = []
+                genes = genes.to_pylist()
+                start = 0
+                for i in range(1, len(genes) + 1):
+                    if i < len(genes) and genes[i] == genes[start]:
+                        continue
+                    gene = genes[start]
+                    if gene not in self._replaced_genes:
+                        pieces.append(table.slice(start, i - start))
+                    elif gene not in placed and gene in new_rows:
+                        placed.add(gene)
+                        pieces.append(new_table.take(new_rows[gene]))
+                    start = i
+                pieces = [piece for piece in pieces if piece.num_rows > 0]
+                if len(pieces) == 0:
+                    os.remove(part_file)
+                    continue
+                self._WritePart(self._ConcatParts(pieces), part_file)
+            # rows moved into earlier part files leave this run's part files
+            moved = pa.array(sorted(placed), type=pa.string())
+            for part_file in part_files:
+                table = self._ReadPart(part_file)
+                keep = pa.compute.invert(pa.compute.is_in(table.column('gene').cast(pa.string()), value_set=moved))  # noqa
+                if pa.compute.all(keep).as_py():
+                    continue
+                table = table.filter(keep)
+                if table.num_rows == 0:
+                    os.remove(part_file)
+                else:
+                    self._WritePart(table, part_file)
+
+    def Close(self):
+        '''
+        write what is left in the buffers and close all files
+        '''
+        outcomes = []
+        for file_name in list(self._buffers):
+            outcomes += self.Flush(file_name)
+        for file_name in list(self._handles):
+            self._CloseHandle(file_name)
+        if self._earlier_output and self._replaced_genes:
+            try:
+                self._DropReplacedRows()
+            except Exception as e:
+                logger.error(f'Error occured when dropping earlier results of replaced genes: {e}')  # noqa
+                raise RuntimeError(f'STEP 4 - earlier results of changed genes could not be dropped: {e}') from e  # noqa
+        self.closed = True
+        return outcomes
+
+
+def CreateRequestSession(metadata: QueryMetaData):
+    '''
+    new request session with pooled connections, headers and cookies set,
+    wrapped in a RequestTransport configured by metadata
+    '''
+    session = rq.session()
+    # size the connection pool so that concurrent workers reuse connections
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=max(metadata.workers, 10))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session_config = RequestSessionConfiguration()
+    session.headers.update(session_config.SessionSettingGetter())
+    for k, v in session_config.CookiesSettingGetter().items():
+        session.cookies.set(k, v)
+    return RequestTransport(session=session,
+                            connect_timeout=metadata.connect_timeout,
+                            read_timeout=metadata.read_timeout,
+                            max_retries=metadata.max_retries,
+                            max_rate=metadata.max_rate,
+                            breaker_threshold=metadata.breaker_threshold,
+                            breaker_pause=metadata.breaker_pause)
+
+
+def IterFormattedGenes(genes, metadata: QueryMetaData, session, cache=None,
+                       metrics=None, log_file=None, refresh=None):
+    '''
+    fetch (step 1-2) and format (step 3) genes as configured by metadata,
+    yield (gene, formatted, error) in input order, formatted is the
+    {data_tag: ...} dict of FormatPayloads and error is None on success,
+    formatting runs in a process pool if parse_workers > 0; store and
+    summary need the regulation of every row, with a store whole
+    payloads are formatted and pattern rows are selected by the caller
+    '''
+    data_pattern = metadata.data_pattern if metadata.store == '' else ''
+    with_regulation = metadata.store != '' or metadata.summary
+    fetched = IterFetchedGenes(genes=genes,
+                               session=session,
+                               db_url=metadata.db_url,
+                               data_tags=SplitDataTags(metadata.data_tag),
+                               workers=metadata.workers,
+                               max_per_host=metadata.max_per_host,
+                               cache=cache,
+                               cache_only=metadata.cache_only,
+                               metrics=metrics,
+                               window=metadata.queue_size,
+                               optimistic=metadata.optimistic,
+                               refresh=refresh)
+    # optional process pool so formatting runs beside fetching, the caller
+    # stays the single consumer, bounded windows between the stages keep
+    # memory flat however long the gene list is
+    parse_pool = None
+    stream = fetched
+    if metadata.parse_workers > 0:
+        # spawn, since forking next to running fetch threads can copy held locks # noqa
+        parse_pool = ProcessPoolExecutor(max_workers=metadata.parse_workers,
+                                         mp_context=mp.get_context('spawn'),
+                                         initializer=InitParseWorker,
+                                         initargs=(log_file, metadata.gene_log_sample))  # noqa
+        stream = IterParsedGenes(fetched=fetched,
+                                 parse_pool=parse_pool,
+                                 data_pattern=data_pattern,
+                                 pattern_overlap=metadata.pattern_overlap,
+                                 window=metadata.queue_size if metadata.queue_size > 0 else metadata.parse_workers * 4,  # noqa
+                                 with_regulation=with_regulation)
     try:
-        logger.info(f'Trying to write formatted results in csv file with path {file_name}')
-        with open(file_name, 'a') as w_file:
-            w_file.write(csv)
-    except Exception as e:
-        logger.error(f'Error occured when writing formatted results into given path: {e}]')
-        raise e(f'STEP 4 - results writing for gene {gene} failed')
-    logger.info(f'Formatted results writing for gene {gene} is finished (4/4)')
+        for gene, future in stream:
+            formatted, error = None, None
+            try:
+                if parse_pool is not None:
+                    formatted, seconds, n_bytes = future.result()
+                    if metrics is not None:
+                        metrics.Record('format', gene, seconds, n_bytes)
+                else:
+                    contents = future.result()
+                    with StageTimer(metrics, 'format', gene) as record:
+                        record['bytes'] = sum(len(content) for content in contents.values() if content is not None)  # noqa
+                        formatted = FormatPayloads(gene=gene,
+                                                   contents=contents,
+                                                   data_pattern=data_pattern,  # noqa
+                                                   pattern_overlap=metadata.pattern_overlap,  # noqa
+                                                   with_regulation=with_regulation)  # noqa
+            except Exception as e:
+                error = e
+            yield gene, formatted, error
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+
+
+def FetchExpression(genes, *, data_tag='tbox', patterns='', as_arrow=False,
+                    on_error='skip', failed=None, **options):
+    '''
+    library entry point, fetch expression data of an iterable of gene IDs
+    and yield (gene, typed DataFrame) in input order, nothing is written
+    to disk; patterns is a '_'-joined str or a list of patterns, further
+    QueryMetaData fields (db_url, workers, cache_dir, ...) can be given
+    as keyword arguments; every call has its own settings and session,
+    so several calls may run side by side;
+    failed genes are skipped (on_error='skip') and put into the failed
+    dict if given, or raised right away (on_error='raise');
+    with as_arrow=True pyarrow RecordBatches are yielded instead
+    '''
+    if on_error not in ('skip', 'raise'):
+        raise ValueError(f'on_error can only be either skip or raise, but got {on_error}!')  # noqa
+    if not isinstance(patterns, str):
+        patterns = '_'.join(patterns)
+    metadata = QueryMetaData(data_tag=data_tag, data_pattern=patterns, **options)  # noqa
+    data_tags = SplitDataTags(data_tag)
+    if len(data_tags) != 1 or data_tags[0] not in tag_parsers:
+        raise ValueError(f'FetchExpression takes one data tag with a parser ({", ".join(tag_parsers)}), but got {data_tag}!')  # noqa
+    if metadata.pattern_overlap not in PatternMatcher.overlap_modes:
+        raise ValueError(f'Pattern overlap mode can only be either duplicate or first, but got {metadata.pattern_overlap}!')  # noqa
+    if metadata.cache_only and metadata.cache_dir == '':
+        raise ValueError('Cache-only mode needs a payload cache, please give cache_dir!')  # noqa
+    if metadata.refresh:
+        raise ValueError('FetchExpression keeps no refresh state, refresh is only available for runs writing to out_dir!')  # noqa
+    if metadata.store != '' or metadata.summary:
+        raise ValueError('FetchExpression writes nothing, store and summary are only available for runs writing to out_dir!')  # noqa
+    if as_arrow:
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError('Arrow output needs pyarrow, please install it first, e.g. "pip install pyarrow"') from e  # noqa
+    if isinstance(genes, str):
+        genes = [genes]
+    reader = GeneListReader(gene_list='', list_sep=metadata.list_sep,
+                            id_pattern=metadata.id_pattern)
+    cache = None
+    if metadata.cache_dir != '':
+        cache = PayloadCache(cache_dir=metadata.cache_dir,
+                             ttl_hours=metadata.cache_ttl,
+                             max_mb=metadata.cache_max_mb)
+    session = CreateRequestSession(metadata)
+    try:
+        stream = IterFormattedGenes(genes=ShardGenes(reader.IterGenes(genes), metadata.shard),  # noqa
+                                    metadata=metadata,
+                                    session=session,
+                                    cache=cache)
+        with contextlib.closing(stream):
+            for gene, formatted, error in stream:
+                if error is not None:
+                    if on_error == 'raise':
+                        raise error
+                    logger.warning(f'Data of gene {gene} is skipped: {error}')
+                    if failed is not None:
+                        failed[gene] = error
+                    continue
+                df_results = ResultsToDataFrame(*formatted[data_tags[0]])
+                if as_arrow:
+                    yield gene, pyarrow.RecordBatch.from_pandas(df_results, preserve_index=False)  # noqa
+                else:
+                    yield gene, df_results
+    finally:
+        session.session.close()
+        if failed is not None:
+            for gene in reader.invalid_genes:
+                failed[gene] = ValueError(f'Gene ID {gene} does not match the ID pattern')  # noqa
+
+
+class RawPayloadWriter:
+    '''
+    write payloads of a data tag without parser as they are,
+    one file per gene named like the database resource
+    '''
+    def __init__(self, out_dir, data_tag, metrics=None):
+        self.out_dir = out_dir
+        self.data_tag = data_tag
+        self.metrics = metrics
+
+    def FileName(self, gene):
+        return os.path.join(self.out_dir, f'{gene}.{self.data_tag}')
+
+    def Add(self, gene, content):
+        '''
+        write the payload of one gene, returns [(gene, error)]
+        '''
+        file_name = self.FileName(gene)
+        try:
+            with StageTimer(self.metrics, 'write', gene) as record:
+                data = content.encode('utf-8')
+                with open(f'{file_name}.tmp', 'wb') as w_file:
+                    w_file.write(data)
+                os.replace(f'{file_name}.tmp', file_name)
+                record['bytes'] = len(data)
+        except Exception as e:
+            logger.error(f'Error occured when writing {self.data_tag} data of gene {gene}: {e}')  # noqa
+            return [(gene, RuntimeError(f'STEP 4 - writing {self.data_tag} data for gene {gene} failed: {e}'))]  # noqa
+        return [(gene, None)]
+
+
+class MatrixWriter:
+    '''
+    fill disk-backed gene x treatment_project matrices (one .npy per
+    measure, float32, NaN where a gene has no data) gene by gene,
+    both axes grow by doubling the memory-mapped arrays, so the whole
+    matrix is never held in memory; row and column labels are kept in
+    genes / treatments index files next to the arrays
+    '''
+    measures = ('expression_fpkm_mock', 'expression_fpkm_treated', 'avg_log2fc')  # noqa
+    chunk_rows = 4096  # rows copied at once when an array grows
+
+    def __init__(self, out_dir, data_pattern, reopen=False):
+        prefix = data_pattern if data_pattern != '' else 'whole_extract'
+        self.prefix = os.path.join(out_dir, f'{prefix}_matrix')
+        self.genes = []
+        self.treatments = []
+        self._gene_rows = {}
+        self._treatment_columns = {}
+        self._arrays = {}
+        self.closed = False
+        if reopen and all(os.path.exists(path) for path in self._Files()):
+            # continue an earlier run, its index files mark the valid region
+            self.genes = self._ReadIndex(self.GenesPath())
+            self.treatments = self._ReadIndex(self.TreatmentsPath())
+            self._gene_rows = {gene: i for i, gene in enumerate(self.genes)}
+            self._treatment_columns = {label: j for j, label in enumerate(self.treatments)}  # noqa
+            for measure in self.measures:
+                self._arrays[measure] = np.load(self.PathFor(measure), mmap_mode='r+')  # noqa
+            if len(self.genes) > 0:
+                self._Resize(max(len(self.genes), 1024), max(len(self.treatments), 64))  # noqa
+            else:
+                self._arrays = {}
+        if len(self._arrays) == 0:
+            for measure in self.measures:
+                self._arrays[measure] = self._NewArray(self.PathFor(measure), (1024, 64))  # noqa
+
+    def PathFor(self, measure):
+        return f'{self.prefix}_{measure}.npy'
+
+    def GenesPath(self):
+        return f'{self.prefix}_genes.txt'
+
+    def TreatmentsPath(self):
+        return f'{self.prefix}_treatments.txt'
+
+    def _Files(self):
+        return [self.PathFor(measure) for measure in self.measures] + [self.GenesPath(), self.TreatmentsPath()]  # noqa
+
+    @staticmethod
+    def _ReadIndex(path):
+        with open(path, 'r', encoding='utf-8') as r_file:
+            return [line.rstrip('\n') for line in r_file]
+
+    @staticmethod
+    def _WriteIndex(path, labels):
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as w_file:
+            w_file.writelines(f'{label}\n' for label in labels)
+        os.replace(f'{path}.tmp', path)
+
+    def _NewArray(self, path, shape):
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)  # noqa
+        for start in range(0, shape[0], self.chunk_rows):
+            array[start:start + self.chunk_rows] = np.nan
+        return array
+
+    def _Resize(self, n_rows, n_columns):
+        '''
+        move every array into a new one of the given shape, chunk by chunk
+        '''
+        for measure in self.measures:
+            old = self._arrays[measure]
+            path = self.PathFor(measure)
+            new = self._NewArray(f'{path}.tmp', (n_rows, n_columns))
+            keep_rows = min(old.shape[0], n_rows, len(self.genes))
+            keep_columns = min(old.shape[1], n_columns, len(self.treatments))
+            for start in range(0, keep_rows, self.chunk_rows):
+                stop = min(start + self.chunk_rows, keep_rows)
+                new[start:stop, :keep_columns] = old[start:stop, :keep_columns]  # noqa
+            new.flush()
+            del old
+            os.replace(f'{path}.tmp', path)
+            self._arrays[measure] = new
+
+    def Add(self, gene, results):
+        '''
+        put the values of one formatted gene into its row, a gene written
+        before (refresh) gets its row cleared first
+        '''
+        row = self._gene_rows.get(gene)
+        if row is None:
+            row = len(self.genes)
+            self._gene_rows[gene] = row
+            self.genes.append(gene)
+            new_row = True
+        else:
+            new_row = False
+        columns = np.empty(len(results['treatment_project']), dtype=np.intp)
+        for i, label in enumerate(results['treatment_project']):
+            column = self._treatment_columns.get(label)
+            if column is None:
+                column = len(self.treatments)
+                self._treatment_columns[label] = column
+                self.treatments.append(label)
+            columns[i] = column
+        n_rows, n_columns = self._arrays[self.measures[0]].shape
+        if len(self.genes) > n_rows or len(self.treatments) > n_columns:
+            while n_rows < len(self.genes):
+                n_rows *= 2
+            while n_columns < len(self.treatments):
+                n_columns *= 2
+            self._Resize(n_rows, n_columns)
+        for measure in self.measures:
+            array = self._arrays[measure]
+            if not new_row:
+                array[row] = np.nan
+            array[row, columns] = np.asarray(results[measure], dtype=np.float32)  # noqa
+
+    def Checkpoint(self):
+        '''
+        flush the arrays and write the index files of what was added so far
+        '''
+        for array in self._arrays.values():
+            array.flush()
+        self._WriteIndex(self.TreatmentsPath(), self.treatments)
+        self._WriteIndex(self.GenesPath(), self.genes)
+
+    def Close(self):
+        '''
+        shrink the arrays to n_genes x n_treatments and write the indices
+        '''
+        if len(self.genes) > 0:
+            self._Resize(len(self.genes), len(self.treatments))
+        else:
+            self._arrays = {}
+            for measure in self.measures:
+                np.save(self.PathFor(measure), np.empty((0, 0), dtype=np.float32))  # noqa
+        self.Checkpoint()
+        self._arrays = {}
+        self.closed = True
+
+
+def LoadMatrix(out_dir, data_pattern='', measure='avg_log2fc'):
+    '''
+    open a matrix written with --matrix read-only and memory-mapped,
+    returns (genes, treatments, array), slicing only reads what is needed
+    '''
+    prefix = data_pattern if data_pattern != '' else 'whole_extract'
+    path = os.path.join(out_dir, f'{prefix}_matrix')
+    genes = MatrixWriter._ReadIndex(f'{path}_genes.txt')
+    treatments = MatrixWriter._ReadIndex(f'{path}_treatments.txt')
+    array = np.load(f'{path}_{measure}.npy', mmap_mode='r')
+    return genes, treatments, array[:len(genes), :len(treatments)]
+
+
+class ResultsStore:
+    '''
+    SQLite store of every formatted row, genes / treatment_project
+    labels / regulations are kept once in their own tables and the
+    mock / treated measurements refer to them; rows of a gene stored
+    again replace the earlier ones, so refreshed and resumed runs can
+    share a store; patterns are matched against treatment_project
+    labels once and kept in an indexed keyword table
+    '''
+    label_tables = ('gene', 'treatment_project', 'regulation')
+    measure_columns = ('expression_fpkm_mock', 'expression_fpkm_treated',
+                       'stderr_mock', 'stderr_treated', 'avg_log2fc',
+                       'single_dpts_mock', 'single_dpts_treated')
+    schema = '''
+        CREATE TABLE IF NOT EXISTS gene (
+            gene_id INTEGER PRIMARY KEY, gene TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS treatment_project (
+            treatment_project_id INTEGER PRIMARY KEY, treatment_project TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS regulation (
+            regulation_id INTEGER PRIMARY KEY, regulation TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS measurement (
+            gene_id INTEGER NOT NULL REFERENCES gene,
+            treatment_project_id INTEGER NOT NULL REFERENCES treatment_project,
+            regulation_id INTEGER NOT NULL REFERENCES regulation,
+            expression_fpkm_mock REAL, expression_fpkm_treated REAL,
+            stderr_mock REAL, stderr_treated REAL, avg_log2fc REAL,
+            single_dpts_mock TEXT, single_dpts_treated TEXT);
+        CREATE TABLE IF NOT EXISTS keyword (
+            keyword TEXT PRIMARY KEY, matched_upto INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS treatment_keyword (
+            keyword TEXT NOT NULL, treatment_project_id INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS measurement_gene ON measurement (gene_id);
+        CREATE INDEX IF NOT EXISTS measurement_treatment ON measurement (treatment_project_id);
+        CREATE INDEX IF NOT EXISTS treatment_keyword_keyword ON treatment_keyword (keyword);
+    '''  # noqa
+
+    def __init__(self, path):
+        self.path = path
+        # several shard runs may write to one store, every gene is committed
+        # on its own, so a run only ever waits for the gene of another run
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+        self._ids = {table: {} for table in self.label_tables}
+        self.closed = False
+
+    def _LabelIds(self, table, labels):
+        '''
+        ids of labels in one of the label tables, new labels are added
+        '''
+        ids = self._ids[table]
+        new_labels = list({label for label in labels if label not in ids})
+        if len(new_labels) > 0:
+            self.connection.executemany(f'INSERT OR IGNORE INTO {table} ({table}) VALUES (?)',  # noqa
+                                        [(label,) for label in new_labels])
+            for start in range(0, len(new_labels), 500):
+                chunk = new_labels[start:start + 500]
+                rows = self.connection.execute(f'SELECT {table}_id, {table} FROM {table} WHERE {table} IN ({",".join("?" * len(chunk))})', chunk)  # noqa
+                ids.update((label, label_id) for label_id, label in rows)
+        return [ids[label] for label in labels]
+
+    def Add(self, gene, results):
+        '''
+        replace the stored rows of one gene, formatted with regulation,
+        in one transaction committed right away
+        '''
+        try:
+            with self.connection:
+                gene_id = self._LabelIds('gene', [gene])[0]
+                columns = [self._LabelIds('treatment_project', results['treatment_project']),  # noqa
+                           self._LabelIds('regulation', results['regulation'])]  # noqa
+                # float32 arrays go in as python floats, NaN is stored as NULL
+                columns += [results[column].tolist() if isinstance(results[column], np.ndarray) else results[column]  # noqa
+                            for column in self.measure_columns]
+                self.connection.execute('DELETE FROM measurement WHERE gene_id = ?', (gene_id,))  # noqa
+                self.connection.executemany(f'INSERT INTO measurement VALUES (?, ?, ?, {", ".join("?" * len(self.measure_columns))})',  # noqa
+                                            ((gene_id, *row) for row in zip(*columns)))  # noqa
+        except Exception:
+            # ids of labels added by the rolled back transaction are void
+            self._ids = {table: {} for table in self.label_tables}
+            raise
+
+    def Close(self):
+        self.connection.commit()
+        self.connection.close()
+        self.closed = True
+
+    def _MatchKeyword(self, pattern):
+        '''
+        bring the treatment_keyword rows of one (lower-case) pattern up
+        to date, only labels added since the last match are scanned
+        '''
+        row = self.connection.execute('SELECT matched_upto FROM keyword WHERE keyword = ?', (pattern,)).fetchone()  # noqa
+        matched_upto = row[0] if row is not None else 0
+        labels = self.connection.execute('SELECT treatment_project_id, treatment_project FROM treatment_project WHERE treatment_project_id > ?', (matched_upto,)).fetchall()  # noqa
+        if row is not None and len(labels) == 0:
+            return
+        matcher = PatternMatcher([pattern])
+        self.connection.executemany('INSERT INTO treatment_keyword VALUES (?, ?)',  # noqa
+                                    [(pattern, label_id) for label_id, label in labels if matcher.Match(label)])  # noqa
+        matched_upto = max([matched_upto] + [label_id for label_id, _ in labels])  # noqa
+        self.connection.execute('INSERT OR REPLACE INTO keyword VALUES (?, ?)', (pattern, matched_upto))  # noqa
+        self.connection.commit()
+
+    def Query(self, data_pattern='', pattern_overlap='duplicate', genes=None,
+              regulation='', min_log2fc=None, max_log2fc=None,
+              min_abs_log2fc=None, min_fpkm=None):
+        '''
+        stored rows passing all given filters as (results, dtype), patterns
+        select rows like data_pattern of a fetch run does and add keyword
+        and gene columns, rows come in the order of genes if given, else
+        in stored order; min_fpkm applies to the higher of mock / treated
+        '''
+        matcher = CompilePatterns(data_pattern, pattern_overlap)
+        joins, where, params = [], [], []
+        order = ['m.gene_id']
+        if matcher is not None:
+            # pattern index of every matching treatment, by PatternMatcher rules
+            lower_patterns = [pattern.lower() for pattern in matcher.pattern_list]  # noqa
+            for pattern in set(lower_patterns):
+                self._MatchKeyword(pattern)
+            matches = {}
+            rows = self.connection.execute(f'SELECT keyword, treatment_project_id FROM treatment_keyword WHERE keyword IN ({",".join("?" * len(lower_patterns))})', lower_patterns)  # noqa
+            for keyword, label_id in rows:
+                matches.setdefault(label_id, set()).update(k for k, pattern in enumerate(lower_patterns) if pattern == keyword)  # noqa
+            pattern_rows = []
+            for label_id, indices in matches.items():
+                indices = sorted(indices)
+                if pattern_overlap == 'first':
+                    indices = indices[:1]
+                pattern_rows += [(label_id, k) for k in indices]
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS query_treatment (treatment_project_id INTEGER, pattern_rank INTEGER)')  # noqa
+            self.connection.execute('DELETE FROM query_treatment')
+            self.connection.executemany('INSERT INTO query_treatment VALUES (?, ?)', pattern_rows)  # noqa
+            joins.append('JOIN query_treatment q ON q.treatment_project_id = m.treatment_project_id')  # noqa
+            order.append('q.pattern_rank')
+        if genes is not None:
+            gene_ids = self._ids['gene']
+            known = dict(self.connection.execute('SELECT gene, gene_id FROM gene'))  # noqa
+            gene_ids.update(known)
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS query_gene (gene_id INTEGER, gene_rank INTEGER)')  # noqa
+            self.connection.execute('DELETE FROM query_gene')
+            self.connection.executemany('INSERT INTO query_gene VALUES (?, ?)',  # noqa
+                                        [(gene_ids[gene], rank) for rank, gene in enumerate(genes) if gene in gene_ids])  # noqa
+            joins.append('JOIN query_gene qg ON qg.gene_id = m.gene_id')
+            order = ['qg.gene_rank'] + order[1:]
+        if regulation != '':
+            where.append('r.regulation = ?')
+            params.append(regulation)
+        for condition, value in (('m.avg_log2fc >= ?', min_log2fc),
+                                 ('m.avg_log2fc <= ?', max_log2fc),
+                                 ('ABS(m.avg_log2fc) >= ?', min_abs_log2fc),
+                                 ('MAX(m.expression_fpkm_mock, m.expression_fpkm_treated) >= ?', min_fpkm)):  # noqa
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        sql = ' '.join(['SELECT r.regulation, t.treatment_project,',
+                        ', '.join(f'm.{column}' for column in self.measure_columns) + ',',  # noqa
+                        'q.pattern_rank,' if matcher is not None else 'NULL,',
+                        'g.gene FROM measurement m',
+                        'JOIN gene g ON g.gene_id = m.gene_id',
+                        'JOIN treatment_project t ON t.treatment_project_id = m.treatment_project_id',  # noqa
+                        'JOIN regulation r ON r.regulation_id = m.regulation_id',  # noqa
+                        *joins,
+                        'WHERE ' + ' AND '.join(where) if len(where) > 0 else '',  # noqa
+                        'ORDER BY ' + ', '.join(order + ['m.rowid'])])
+        rows = self.connection.execute(sql, params).fetchall()
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * (len(self.measure_columns) + 4)  # noqa
+        results = {'regulation': list(columns[0]),
+                   'treatment_project': list(columns[1])}
+        dtype = {'regulation': pd.StringDtype(),
+                 'treatment_project': pd.StringDtype()}
+        for column, values in zip(self.measure_columns, columns[2:]):
+            if column.startswith('single_dpts'):
+                results[column] = list(values)
+                dtype[column] = pd.StringDtype()
+            else:
+                # NULL comes back as None, which numpy turns into NaN
+                results[column] = np.array(values, dtype=np.float64).astype(np.float32)  # noqa
+                dtype[column] = pd.Float32Dtype()
+        if matcher is not None:
+            results['keyword'] = [matcher.pattern_list[k] for k in columns[-2]]  # noqa
+        results['gene'] = list(columns[-1])
+        return results, dtype
 
 
 class InfoTablePrinter:
@@ -355,7 +2300,10 @@ class InfoTablePrinter:
                 'delimiter': self.metadata.list_sep,
                 'data source': self.metadata.data_tag,
                 'treatment': self.metadata.data_pattern if self.metadata.data_pattern != '' else 'none',
-                'output dir': self.metadata.out_dir
+                'output dir': self.metadata.out_dir,
+                'output format': self.metadata.out_format,
+                'workers': str(self.metadata.workers),
+                'payload cache': self.metadata.cache_dir if self.metadata.cache_dir != '' else 'none'  # noqa
                 }
 
     def PaddingPrint(self):
@@ -397,6 +2345,176 @@ class InfoTablePrinter:
         print(top_bottom)
 
 
+class RunningSummary:
+    '''
+    cross-gene statistics per keyword and treatment_project, updated
+    with the formatted rows of one gene at a time: genes with up- /
+    down-regulated rows, mean and variance of avg_log2fc (Welford, each
+    gene's moments merged in with Chan's formula) and log-binned FPKM
+    histograms of mock / treated for approximate quantiles, kept sparse
+    as {key * n_bins + bin: count}; memory grows with the number of
+    treatment labels, never with the number of genes
+    '''
+    total = 'all'  # treatment_project of keyword totals, keyword in whole extract mode # noqa
+    quantiles = (0.1, 0.5, 0.9)
+    fpkm_range = (1e-2, 1e6)
+    bin_growth = 1.04  # neighbouring bin edges differ by 4%, quantiles by about 2% # noqa
+
+    def __init__(self):
+        self.keys = []  # (keyword, treatment_project) of every accumulator
+        self._codes = {}
+        self.n_genes = 0
+        self._log_growth = np.log(self.bin_growth)
+        # below the range, in range, above the range
+        self.n_bins = int(np.ceil(np.log(self.fpkm_range[1] / self.fpkm_range[0]) / self._log_growth)) + 2  # noqa
+        self._histograms = {'mock': {}, 'treated': {}}
+        self._Allocate(64)
+
+    def _Allocate(self, capacity):
+        '''
+        (re)allocate the accumulator arrays for capacity keys
+        '''
+        old = getattr(self, '_arrays', None)
+        self._arrays = {'rows': np.zeros(capacity, dtype=np.int64),
+                        'genes_up': np.zeros(capacity, dtype=np.int64),
+                        'genes_down': np.zeros(capacity, dtype=np.int64),
+                        'n': np.zeros(capacity, dtype=np.int64),
+                        'mean': np.zeros(capacity, dtype=np.float64),
+                        'm2': np.zeros(capacity, dtype=np.float64)}
+        if old is not None:
+            for name, values in old.items():
+                self._arrays[name][:len(values)] = values
+
+    def _Code(self, key):
+        code = self._codes.get(key)
+        if code is None:
+            code = len(self.keys)
+            self._codes[key] = code
+            self.keys.append(key)
+            if code >= len(self._arrays['rows']):
+                self._Allocate(2 * len(self._arrays['rows']))
+        return code
+
+    def _Bins(self, values):
+        low, high = self.fpkm_range
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bins = np.floor(np.log(values / low) / self._log_growth) + 1
+        bins = np.where(values < low, 0, np.minimum(bins, self.n_bins - 1))
+        return bins.astype(np.intp)
+
+    def Add(self, results):
+        '''
+        update all accumulators with the rows of one gene, formatted
+        with regulation
+        '''
+        n_rows = len(results['treatment_project'])
+        self.n_genes += 1
+        if n_rows == 0:
+            return
+        keywords = results['keyword'] if 'keyword' in results else [self.total] * n_rows  # noqa
+        # every row counts for its treatment and for its keyword total
+        codes = np.fromiter((self._Code(key) for key in zip(keywords, results['treatment_project'])),  # noqa
+                            dtype=np.intp, count=n_rows)
+        codes = np.concatenate([codes, np.fromiter((self._Code((keyword, self.total)) for keyword in keywords),  # noqa
+                                                   dtype=np.intp, count=n_rows)])  # noqa
+        arrays = self._arrays
+        np.add.at(arrays['rows'], codes, 1)
+        regulation = np.tile(np.asarray(results['regulation'], dtype=object), 2)  # noqa
+        for direction in ('up', 'down'):
+            # a gene counts once per key, however many of its rows match
+            arrays[f'genes_{direction}'][np.unique(codes[regulation == direction])] += 1  # noqa
+        log2fc = np.tile(np.asarray(results['avg_log2fc'], dtype=np.float64), 2)  # noqa
+        valid = ~np.isnan(log2fc)
+        if valid.any():
+            keys, inverse = np.unique(codes[valid], return_inverse=True)
+            values = log2fc[valid]
+            n_b = np.bincount(inverse)
+            mean_b = np.bincount(inverse, weights=values) / n_b
+            m2_b = np.bincount(inverse, weights=(values - mean_b[inverse]) ** 2)  # noqa
+            n_a, mean_a = arrays['n'][keys], arrays['mean'][keys]
+            n = n_a + n_b
+            delta = mean_b - mean_a
+            arrays['mean'][keys] = mean_a + delta * n_b / n
+            arrays['m2'][keys] += m2_b + delta ** 2 * n_a * n_b / n
+            arrays['n'][keys] = n
+        for condition in ('mock', 'treated'):
+            fpkm = np.tile(np.asarray(results[f'expression_fpkm_{condition}'], dtype=np.float64), 2)  # noqa
+            valid = ~np.isnan(fpkm)
+            cells, counts = np.unique(codes[valid] * self.n_bins + self._Bins(fpkm[valid]), return_counts=True)  # noqa
+            histogram = self._histograms[condition]
+            for cell, count in zip(cells.tolist(), counts.tolist()):
+                histogram[cell] = histogram.get(cell, 0) + count
+
+    def _Quantiles(self, condition):
+        '''
+        quantiles of every key from the sparse histogram of one
+        condition, shape (n_keys, n_quantiles), NaN for keys without data
+        '''
+        values = np.full((len(self.keys), len(self.quantiles)), np.nan)
+        histogram = self._histograms[condition]
+        if len(histogram) == 0:
+            return values
+        cells = np.fromiter(histogram.keys(), dtype=np.int64, count=len(histogram))  # noqa
+        counts = np.fromiter(histogram.values(), dtype=np.int64, count=len(histogram))  # noqa
+        order = np.argsort(cells)
+        codes, bins = np.divmod(cells[order], self.n_bins)
+        cumulative = np.cumsum(counts[order])
+        # cells are grouped by key, bins ascending within a key
+        ends = np.r_[np.flatnonzero(codes[1:] != codes[:-1]), len(codes) - 1]
+        before = np.r_[0, cumulative[ends[:-1]]]
+        totals = cumulative[ends] - before
+        low, high = self.fpkm_range
+        for j, q in enumerate(self.quantiles):
+            b = bins[np.searchsorted(cumulative, before + q * totals)]
+            # geometric middle of the bin, 0 below and the upper end above the range # noqa
+            values[codes[ends], j] = np.where(b == 0, 0.0, np.where(b == self.n_bins - 1, high, low * self.bin_growth ** (b - 0.5)))  # noqa
+        return values
+
+    def Table(self):
+        '''
+        one row per key as a DataFrame, every keyword total followed by
+        the treatments of the keyword, in order of appearance
+        '''
+        n_keys = len(self.keys)
+        keywords = [keyword for keyword, _ in self.keys]
+        treatments = [treatment for _, treatment in self.keys]
+        keyword_codes = np.fromiter((self._codes[(keyword, self.total)] for keyword in keywords), dtype=np.int64, count=n_keys)  # noqa
+        is_treatment = np.fromiter((treatment != self.total for treatment in treatments), dtype=bool, count=n_keys)  # noqa
+        order = np.lexsort((np.arange(n_keys), is_treatment, keyword_codes))
+        arrays = {name: values[:n_keys] for name, values in self._arrays.items()}  # noqa
+        n = arrays['n']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log2fc_var = np.where(n > 1, arrays['m2'] / (n - 1), np.nan)
+        columns = {'keyword': [keywords[code] for code in order],
+                   'treatment_project': [treatments[code] for code in order],
+                   'n_rows': arrays['rows'][order],
+                   'genes_up': arrays['genes_up'][order],
+                   'genes_down': arrays['genes_down'][order],
+                   'log2fc_mean': np.where(n > 0, arrays['mean'], np.nan)[order],  # noqa
+                   'log2fc_var': log2fc_var[order]}
+        for condition in ('mock', 'treated'):
+            values = self._Quantiles(condition)[order]
+            for j, q in enumerate(self.quantiles):
+                columns[f'fpkm_{condition}_p{int(q * 100)}'] = values[:, j]
+        return pd.DataFrame(columns)
+
+    def Write(self, out_dir, data_pattern):
+        prefix = data_pattern if data_pattern != '' else 'whole_extract'
+        path = os.path.join(out_dir, f'{prefix}_summary.csv')
+        self.Table().to_csv(path, index=False, float_format='%.6g')
+        return path
+
+    def Print(self):
+        '''
+        headline numbers of every keyword, next to SummaryPrinter
+        '''
+        df_summary = self.Table()
+        df_summary = df_summary[df_summary['treatment_project'] == self.total]
+        print(f'Summary over {self.n_genes} genes (keyword | rows | genes up / down | log2FC mean ± sd | median FPKM mock / treated):')  # noqa
+        for row in df_summary.itertuples(index=False):
+            print(f'{row.keyword} | {row.n_rows} | {row.genes_up} / {row.genes_down} | {row.log2fc_mean:.3f} ± {np.sqrt(row.log2fc_var):.3f} | {row.fpkm_mock_p50:.3g} / {row.fpkm_treated_p50:.3g}')  # noqa
+
+
 def SummaryPrinter(suc_genes:list, fail_genes:dict):
     if len(suc_genes) != 0:
         print(f'Successful data fetching for following genes:')
@@ -411,59 +2529,566 @@ def SummaryPrinter(suc_genes:list, fail_genes:dict):
         print(f'{k} | {v}')
 
 
-def main():
+def MergeCsvShards(shard_files, out_file, rank):
+    '''
+    interleave the rows of shard csv files (path, committed size) by the
+    gene list rank of their gene, rows are only indexed by shard, offset
+    and length and then copied as they are
+    '''
+    header = None
+    keys, shards, offsets, lengths = array('q'), array('q'), array('q'), array('q')  # noqa
+    handles = []
+    try:
+        for k, (path, end) in enumerate(shard_files):
+            r_file = open(path, 'rb')
+            handles.append(r_file)
+            line = r_file.readline()
+            if header is None:
+                header = line
+                gene_index = header.decode('utf-8').rstrip('\r\n').split(',').index('gene')  # noqa
+            elif line != header:
+                raise ValueError(f'Columns of {path} differ from those of the other shards!')  # noqa
+            offset = len(line)
+            while offset < end:
+                line = r_file.readline()
+                if not line:
+                    break
+                gene = line.decode('utf-8').rstrip('\r\n').split(',')[gene_index]  # noqa
+                keys.append(rank.get(gene, len(rank)))
+                shards.append(k)
+                offsets.append(offset)
+                lengths.append(len(line))
+                offset += len(line)
+        if header is None:
+            return 0
+        # stable, so rows of one gene keep their order
+        order = np.argsort(np.frombuffer(keys, dtype=np.int64), kind='stable')  # noqa
+        with open(f'{out_file}.tmp', 'wb') as w_file:
+            w_file.write(header)
+            for i in order:
+                r_file = handles[shards[i]]
+                r_file.seek(offsets[i])
+                w_file.write(r_file.read(lengths[i]))
+        os.replace(f'{out_file}.tmp', out_file)
+    finally:
+        for r_file in handles:
+            r_file.close()
+    return len(order)
+
+
+def MergeColumnarShards(shard_datasets, metadata: QueryMetaData, rank):
+    '''
+    combine parquet / feather shard datasets, given as (directory,
+    committed part names or None), the rows are sorted by gene list
+    rank and pattern and written again like a single run would;
+    unlike csv this needs the shard tables in memory
+    '''
+    try:
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(f'Merging {metadata.out_format} output needs pyarrow, please install it first, e.g. "pip install pyarrow"') from e  # noqa
+    frames = []
+    partitioned = False
+    for dataset, committed in shard_datasets:
+        for root, _, names in sorted(os.walk(dataset)):
+            keyword = os.path.relpath(root, dataset)
+            for name in sorted(names):
+                if not name.endswith(f'.{metadata.out_format}') or (committed is not None and name not in committed):  # noqa
+                    continue  # unfinished or uncommitted part file
+                part_file = os.path.join(root, name)
+                if metadata.out_format == 'parquet':
+                    df_part = pyarrow.parquet.read_table(part_file).to_pandas()  # noqa
+                else:
+                    df_part = pyarrow.feather.read_table(part_file).to_pandas()  # noqa
+                if keyword.startswith('keyword='):
+                    df_part['keyword'] = keyword[len('keyword='):]
+                    partitioned = True
+                frames.append(df_part)
+    if len(frames) == 0:
+        return 0
+    df_results = pd.concat([df_part.astype({column: str for column in df_part.columns if isinstance(df_part[column].dtype, pd.CategoricalDtype)}) for df_part in frames], ignore_index=True)  # noqa
+    pattern_rank = {pattern: k for k, pattern in enumerate(metadata.data_pattern.split('_'))}  # noqa
+    gene_rank = df_results['gene'].map(lambda gene: rank.get(gene, len(rank))).to_numpy()  # noqa
+    keyword_rank = df_results['keyword'].map(lambda keyword: pattern_rank.get(keyword, len(pattern_rank))).to_numpy()  # noqa
+    df_results = df_results.iloc[np.lexsort((keyword_rank, gene_rank))]
+    dtype = {column: pd.Float32Dtype() if pd.api.types.is_float_dtype(df_results[column].dtype) else pd.StringDtype()  # noqa
+             for column in df_results.columns if column not in ['keyword', 'gene']}  # noqa
+    out_file = OutputFileName(metadata.out_dir, metadata.data_pattern, '', metadata.out_format)  # noqa
+    if os.path.isdir(out_file):
+        logger.warning(f'Earlier merged output {out_file} is replaced')
+        shutil.rmtree(out_file)
+    writer = ResultsWriter(out_dir=metadata.out_dir,
+                           data_pattern=metadata.data_pattern,
+                           batch_rows=metadata.batch_rows,
+                           batch_mb=metadata.batch_mb,
+                           out_format=metadata.out_format,
+                           partition_by_keyword=partitioned)
+    outcomes = []
+    for gene, df_gene in df_results.groupby('gene', sort=False):
+        results = {column: df_gene[column].to_numpy(dtype=np.float32, na_value=np.nan) if column in dtype and dtype[column] == pd.Float32Dtype()  # noqa
+                   else df_gene[column].to_numpy(dtype=object) for column in df_gene.columns}  # noqa
+        outcomes += writer.Add(gene, results, dtype)
+    outcomes += writer.Close()
+    for gene, error in outcomes:
+        if error is not None:
+            raise error
+    return len(df_results)
+
+
+def MergeShardMatrices(shard_dirs, metadata: QueryMetaData, rank):
+    '''
+    combine shard matrices row by row in gene list order
+    '''
+    shard_matrices = []
+    rows = []
+    for shard_dir in shard_dirs:
+        arrays = {}
+        for measure in MatrixWriter.measures:
+            genes, treatments, arrays[measure] = LoadMatrix(shard_dir, metadata.data_pattern, measure)  # noqa
+        rows += [(rank.get(gene, len(rank)), len(shard_matrices), i, gene) for i, gene in enumerate(genes)]  # noqa
+        shard_matrices.append((treatments, arrays))
+    merged = MatrixWriter(out_dir=metadata.out_dir,
+                          data_pattern=metadata.data_pattern)
+    for _, k, i, gene in sorted(rows):
+        treatments, arrays = shard_matrices[k]
+        values = {measure: np.asarray(arrays[measure][i]) for measure in MatrixWriter.measures}  # noqa
+        columns = np.flatnonzero(np.any([~np.isnan(row) for row in values.values()], axis=0))  # noqa
+        results = {measure: row[columns] for measure, row in values.items()}
+        results['treatment_project'] = [treatments[j] for j in columns]
+        merged.Add(gene, results)
+    merged.Close()
+    return len(rows)
+
+
+def MergeShards(metadata: QueryMetaData):
+    '''
+    combine the outputs of all shard-i-of-N directories in out_dir into
+    the files a single run would have written, in gene list order
+    '''
+    shard_regex = re.compile(r'shard-(\d+)-of-(\d+)')
+    found = {}
+    for name in os.listdir(metadata.out_dir):
+        matched = shard_regex.fullmatch(name)
+        if matched is not None and os.path.isdir(os.path.join(metadata.out_dir, name)):  # noqa
+            found[(int(matched.group(1)), int(matched.group(2)))] = os.path.join(metadata.out_dir, name)  # noqa
+    if len(found) == 0:
+        raise FileNotFoundError(f'No shard directories (shard-i-of-N) are found in {metadata.out_dir}!')  # noqa
+    counts = {count for _, count in found}
+    if len(counts) > 1:
+        raise ValueError(f'Shard directories of different shard counts {sorted(counts)} are found in {metadata.out_dir}!')  # noqa
+    n_shards = counts.pop()
+    missing = [index for index in range(1, n_shards + 1) if (index, n_shards) not in found]  # noqa
+    if len(missing) > 0:
+        raise ValueError(f'Shards {missing} of {n_shards} are missing in {metadata.out_dir}!')  # noqa
+    shard_dirs = [found[(index, n_shards)] for index in range(1, n_shards + 1)]  # noqa
+    print(f'Merging {n_shards} shards in {metadata.out_dir}...')
+    logger.info(f'Merging of {n_shards} shards is started')
+    # input order of the gene list decides the order of merged rows
+    gene_reader = ReadGenesfromList(gene_list=metadata.gene_list,
+                                    list_format=metadata.list_format,
+                                    list_sep=metadata.list_sep,
+                                    id_pattern=metadata.id_pattern)
+    rank = {gene: i for i, gene in enumerate(gene_reader)}
+    done_genes = set()
+    fail_genes = {}
+    committed = []
+    for shard_dir in shard_dirs:
+        journal_path = RunJournal.PathFor(shard_dir, metadata.data_pattern, metadata.data_tag)  # noqa
+        if not os.path.exists(journal_path):
+            logger.warning(f'Shard {shard_dir} has no journal, all of its output is merged')  # noqa
+            committed.append(None)
+            continue
+        shard_done, shard_failed, offsets = ReadJournal(journal_path)
+        done_genes |= shard_done
+        fail_genes.update(shard_failed)
+        # shard directories may have been moved since, files are matched by name # noqa
+        committed.append({os.path.basename(file_name): offset for file_name, offset in offsets.items()})  # noqa
+    data_tags = SplitDataTags(metadata.data_tag)
+    if any(data_tag in tag_parsers for data_tag in data_tags):
+        if metadata.data_pattern == '':
+            # whole extract mode, every gene has its own file
+            n_files = 0
+            for shard_dir in shard_dirs:
+                for name in os.listdir(shard_dir):
+                    if name.endswith(f'_RNAseq_data.{metadata.out_format}'):
+                        shutil.copy2(os.path.join(shard_dir, name), os.path.join(metadata.out_dir, name))  # noqa
+                        n_files += 1
+            print(f'{n_files} gene files are copied to {metadata.out_dir}')
+        elif metadata.out_format == 'csv':
+            shard_files = []
+            for shard_dir, shard_committed in zip(shard_dirs, committed):
+                path = OutputFileName(shard_dir, metadata.data_pattern, '', 'csv')  # noqa
+                if os.path.exists(path):
+                    end = os.path.getsize(path)
+                    if shard_committed is not None:
+                        end = shard_committed.get(os.path.basename(path), 0)
+                    shard_files.append((path, end))
+            out_file = OutputFileName(metadata.out_dir, metadata.data_pattern, '', 'csv')  # noqa
+            n_rows = MergeCsvShards(shard_files, out_file, rank)
+            print(f'{n_rows} rows are merged into {out_file}')
+        else:
+            shard_datasets = [(OutputFileName(shard_dir, metadata.data_pattern, '', metadata.out_format), shard_committed)  # noqa
+                              for shard_dir, shard_committed in zip(shard_dirs, committed)]  # noqa
+            n_rows = MergeColumnarShards([(dataset, shard_committed) for dataset, shard_committed in shard_datasets if os.path.isdir(dataset)],  # noqa
+                                         metadata, rank)
+            print(f'{n_rows} rows are merged into {OutputFileName(metadata.out_dir, metadata.data_pattern, "", metadata.out_format)}')  # noqa
+    for data_tag in data_tags:
+        if data_tag in tag_parsers:
+            continue
+        for shard_dir in shard_dirs:
+            for name in os.listdir(shard_dir):
+                if name.endswith(f'.{data_tag}'):
+                    shutil.copy2(os.path.join(shard_dir, name), os.path.join(metadata.out_dir, name))  # noqa
+    prefix = metadata.data_pattern if metadata.data_pattern != '' else 'whole_extract'  # noqa
+    matrix_dirs = [shard_dir for shard_dir in shard_dirs
+                   if os.path.exists(os.path.join(shard_dir, f'{prefix}_matrix_genes.txt'))]  # noqa
+    if len(matrix_dirs) > 0:
+        n_genes = MergeShardMatrices(matrix_dirs, metadata, rank)
+        print(f'Matrices of {n_genes} genes are merged')
+    logger.info(f'Merging of {n_shards} shards is finished')
+    SummaryPrinter(suc_genes=sorted(done_genes, key=lambda gene: rank.get(gene, len(rank))),  # noqa
+                   fail_genes=fail_genes)
+
+
+def MergeCli(argv):
+    '''
+    command line of the merge step, python RNAseqDB_fetch.py merge ...
+    '''
+    parser = argparse.ArgumentParser(prog='RNAseqDB_fetch.py merge',
+                                     description='Merge the outputs of --shard runs in out-dir into the files of a single run, in gene list order.')  # noqa
+    parser.add_argument('--out-dir', type=str, required=True,
+                        help='Directory holding the shard-i-of-N directories, merged files are written there')  # noqa
+    parser.add_argument('--gene-list', type=str, required=True,
+                        help='Gene list of the sharded runs, decides the order of merged rows')  # noqa
+    parser.add_argument('--list-format', type=str, default='csv',
+                        help='Format of the gene list file, either csv or txt (default: csv)')  # noqa
+    parser.add_argument('--list-sep', type=str, default=',',
+                        help='Delimiter used in the gene list (default: ",")')
+    parser.add_argument('--id-pattern', type=str, default=r'AT[1-5CM]G\d{5}(\.\d+)?',  # noqa
+                        help='Gene ID pattern of the sharded runs')
+    parser.add_argument('--data-tag', type=str, default='tbox',
+                        help='Data tag(s) of the sharded runs (default: tbox)')
+    parser.add_argument('--data-pattern', type=str, default='',
+                        help='Data pattern of the sharded runs')
+    parser.add_argument('--out-format', type=str, default='csv',
+                        help='Output format of the sharded runs, either csv, parquet or feather (default: csv)')  # noqa
+    parser.add_argument('--batch-rows', type=int, default=10000,
+                        help='Rows per part file of merged parquet / feather output (default: 10000)')  # noqa
+    args = parser.parse_args(argv)
+    if args.out_format not in ResultsWriter.out_formats:
+        raise ValueError(f'Output format can only be either csv, parquet or feather, but got {args.out_format}!')  # noqa
+    metadata = QueryMetaData(gene_list=args.gene_list,
+                             list_format=args.list_format,
+                             list_sep=args.list_sep,
+                             id_pattern=args.id_pattern,
+                             data_tag=args.data_tag,
+                             data_pattern=args.data_pattern,
+                             out_dir=args.out_dir,
+                             out_format=args.out_format,
+                             batch_rows=args.batch_rows)
+    logging.basicConfig(filename=os.path.join(metadata.out_dir, 'message.log'),
+                        format='%(asctime)s - **%(levelname)s**: %(message)s',
+                        level=logging.INFO)
+    MergeShards(metadata)
+
+
+def QueryCli(argv):
+    '''
+    command line of store queries, python RNAseqDB_fetch.py query ...
+    '''
+    parser = argparse.ArgumentParser(prog='RNAseqDB_fetch.py query',
+                                     description='Filter the rows of a results store (--store of a fetch run) locally, without any request.')  # noqa
+    parser.add_argument('--store', type=str, required=True,
+                        help='SQLite file written by a fetch run with --store')  # noqa
+    parser.add_argument('--data-pattern', type=str, default='',
+                        help='Treatment patterns connected by underscore, matched like --data-pattern of a fetch run')  # noqa
+    parser.add_argument('--pattern-overlap', type=str, default='duplicate',
+                        help='Treatments matching several patterns: duplicate (default) or first')  # noqa
+    parser.add_argument('--gene-list', type=str, default='',
+                        help='Only rows of the genes in this list, in list order')  # noqa
+    parser.add_argument('--list-format', type=str, default='csv',
+                        help='Format of the gene list file, either csv or txt (default: csv)')  # noqa
+    parser.add_argument('--list-sep', type=str, default=',',
+                        help='Delimiter used in the gene list (default: ",")')
+    parser.add_argument('--regulation', type=str, default='',
+                        help='Only up- or down-regulated rows')
+    parser.add_argument('--min-log2fc', type=float, default=None,
+                        help='Only rows with avg_log2fc at least this value')
+    parser.add_argument('--max-log2fc', type=float, default=None,
+                        help='Only rows with avg_log2fc at most this value')
+    parser.add_argument('--min-abs-log2fc', type=float, default=None,
+                        help='Only rows with an absolute avg_log2fc at least this value')  # noqa
+    parser.add_argument('--min-fpkm', type=float, default=None,
+                        help='Only rows with mock or treated FPKM at least this value')  # noqa
+    parser.add_argument('--out', type=str, default='',
+                        help='csv file the rows are written to (default: printed)')  # noqa
+    args = parser.parse_args(argv)
+    if args.pattern_overlap not in PatternMatcher.overlap_modes:
+        raise ValueError(f'Pattern overlap mode can only be either duplicate or first, but got {args.pattern_overlap}!')  # noqa
+    if args.regulation not in ('', 'up', 'down'):
+        raise ValueError(f'Regulation can only be either up or down, but got {args.regulation}!')  # noqa
+    if not os.path.exists(args.store):
+        raise FileNotFoundError(f'Results store {args.store} does not exist, write it with --store first!')  # noqa
+    genes = None
+    if args.gene_list != '':
+        genes = list(ReadGenesfromList(gene_list=args.gene_list,
+                                       list_format=args.list_format,
+                                       list_sep=args.list_sep))
+    start = time.perf_counter()
+    store = ResultsStore(args.store)
+    try:
+        results, dtype = store.Query(data_pattern=args.data_pattern,
+                                     pattern_overlap=args.pattern_overlap,
+                                     genes=genes,
+                                     regulation=args.regulation,
+                                     min_log2fc=args.min_log2fc,
+                                     max_log2fc=args.max_log2fc,
+                                     min_abs_log2fc=args.min_abs_log2fc,
+                                     min_fpkm=args.min_fpkm)
+    finally:
+        store.Close()
+    seconds = time.perf_counter() - start
+    df_results = ResultsToDataFrame(results, dtype)
+    if args.out == '':
+        df_results.to_csv(sys.stdout, index=False)
+    else:
+        df_results.to_csv(args.out, index=False)
+        print(f'{len(df_results)} rows of {df_results["gene"].nunique()} genes are found in {seconds * 1000:.1f} ms and written to {args.out}')  # noqa
+
+
+def main(metadata: QueryMetaData):
     suc_genes = []
     fail_genes = {}
     # print metainfo table
-    printer = InfoTablePrinter(QueryMetaData)
+    printer = InfoTablePrinter(metadata)
     printer.PaddingPrint()
     # initialize session and set headers / cookies
     print('Initializing request session settings...')
     logger.info('Request session initialization is started')
     try:
-        session = rq.session()
-        session_config = RequestSessionConfiguration()
-        sessionHeaderArgs = session_config.SessionSettingGetter()
-        session.headers.update(sessionHeaderArgs)
-        sessionCookiesArgs = session_config.CookiesSettingGetter()
-        for k, v in sessionCookiesArgs.items():
-            session.cookies.set(k, v)
+        session = CreateRequestSession(metadata)
         print('Request session is successfully established')
         logger.info('Request session initialization is started is done')
     except Exception as e:
         print('Process is stopped since the initialization failed')
         logger.error(f'Error occured in request session initialization step: {e}')  # noqa
         raise e
+    # per-stage timing and counters, dumped next to message.log
+    metrics = RunMetrics(profile_stage='format' if metadata.profile else None)  # noqa
     # read gene list
-    genes = ReadGenesfromList(gene_list=QueryMetaData.gene_list,
-                              list_format=QueryMetaData.list_format,
-                              list_sep=QueryMetaData.list_sep)
-    print(f'In total {len(genes)} genes are recognized from which data will be fetched')
-    # gene-wise data fetch and results format
-    for gene in tqdm(genes, desc='Iterating over all genes', unit='gene'):
-        try:
-            session = ConductPreSearch(gene=gene,
-                                    session=session,
-                                    db_url=QueryMetaData.db_url,)
-            content = FetchGeneData(session=session,
-                                    gene=gene,
-                                    db_url=QueryMetaData.db_url,
-                                    data_tag=QueryMetaData.data_tag)
-            results, dtype = FormatRawDataFromDb(gene=gene,
-                                                content=content,
-                                                data_pattern=QueryMetaData.data_pattern)
-            WriteFormattedResults(results=results,
-                                  dtype=dtype,
-                                  gene=gene,
-                                  data_pattern=QueryMetaData.data_pattern)
-            suc_genes.append(gene)
-        except Exception as e:
-            fail_genes[gene] = e
+    gene_reader = ReadGenesfromList(gene_list=metadata.gene_list,
+                                    list_format=metadata.list_format,
+                                    list_sep=metadata.list_sep,
+                                    id_pattern=metadata.id_pattern)
+    print('Genes are read from the gene list while data is fetched')
+    if metadata.shard != '':
+        shard_index, n_shards = ParseShard(metadata.shard)
+        print(f'Only genes of shard {shard_index} of {n_shards} are fetched, output goes to {metadata.out_dir}')  # noqa
+    # raw payload cache, lets pattern re-runs skip the network
+    cache = None
+    if metadata.cache_dir != '':
+        cache = PayloadCache(cache_dir=metadata.cache_dir,
+                             ttl_hours=metadata.cache_ttl,
+                             max_mb=metadata.cache_max_mb)
+    # checkpoint journal, decides which genes still need to be processed
+    journal = RunJournal(out_dir=metadata.out_dir,
+                         data_pattern=metadata.data_pattern,
+                         data_tag=metadata.data_tag,
+                         resume=metadata.resume or metadata.retry_failed)
+    failed_genes = set(journal.failed_genes)
+    done_genes = set(journal.done_genes)
+    if metadata.retry_failed:
+        print(f'{len(failed_genes)} previously failed genes will be fetched again')  # noqa
+    elif metadata.resume:
+        print(f'{len(done_genes)} genes already written are skipped after resuming')  # noqa
+
+    def SelectGenes(genes):
+        genes = ShardGenes(genes, metadata.shard)
+        if metadata.retry_failed:
+            return (gene for gene in genes if gene in failed_genes)
+        if metadata.resume:
+            return (gene for gene in genes if gene not in done_genes)
+        return genes
+
+    genes = SelectGenes(iter(gene_reader))
+    # a quick counting pass gives the progress bar its total and ETA
+    n_selected = gene_reader.CountGenes(SelectGenes)
+    # validators and hashes of the last run, unchanged genes are skipped
+    refresh = None
+    changed_genes = set()
+    if metadata.refresh:
+        refresh = RefreshState(out_dir=metadata.out_dir,
+                               data_pattern=metadata.data_pattern,
+                               data_tag=metadata.data_tag)
+        print(f'{len(refresh.entries)} result files of the last run are checked for changes')  # noqa
+    # gene-wise data fetch (concurrent), format and results write (in input order) # noqa
+    stream = IterFormattedGenes(genes=genes,
+                                metadata=metadata,
+                                session=session,
+                                cache=cache,
+                                metrics=metrics,
+                                log_file=os.path.join(metadata.out_dir, 'message.log'),  # noqa
+                                refresh=refresh)
+    # parsed data (only tbox has a parser) is written by ResultsWriter, which
+    # also commits genes to the journal, payloads of other tags are written
+    # as they are beforehand
+    data_tags = SplitDataTags(metadata.data_tag)
+    parsed_tags = [data_tag for data_tag in data_tags if data_tag in tag_parsers]  # noqa
+    raw_writers = [RawPayloadWriter(out_dir=metadata.out_dir,
+                                    data_tag=data_tag,
+                                    metrics=metrics)
+                   for data_tag in data_tags if data_tag not in tag_parsers]
+    writer = None
+    if len(parsed_tags) > 0:
+        writer = ResultsWriter(out_dir=metadata.out_dir,
+                               data_pattern=metadata.data_pattern,
+                               journal=journal,
+                               batch_rows=metadata.batch_rows,
+                               batch_mb=metadata.batch_mb,
+                               out_format=metadata.out_format,
+                               partition_by_keyword=metadata.partition_by_keyword,  # noqa
+                               metrics=metrics,
+                               replace=metadata.refresh)
+    # gene x treatment matrices, continued where a resumed / refreshed run left off # noqa
+    matrix = None
+    if metadata.matrix:
+        matrix = MatrixWriter(out_dir=metadata.out_dir,
+                              data_pattern=metadata.data_pattern,
+                              reopen=metadata.resume or metadata.retry_failed or metadata.refresh)  # noqa
+        matrix_genes = set(matrix.genes)
+        missing = [gene for gene in journal.done_genes if gene not in matrix_genes]  # noqa
+        if metadata.resume and len(missing) > 0:
+            logger.warning(f'{len(missing)} genes written before are missing from the matrix, run again without --resume to rebuild it')  # noqa
+    # every formatted row goes to the store, whatever the data pattern
+    store = None
+    output_matcher = None
+    if metadata.store != '':
+        store = ResultsStore(metadata.store)
+        output_matcher = CompilePatterns(metadata.data_pattern, metadata.pattern_overlap)  # noqa
+    # headline statistics, updated gene by gene without keeping any rows
+    summary = None
+    if metadata.summary:
+        summary = RunningSummary()
+
+    def RecordOutcomes(outcomes):
+        for done_gene, error in outcomes:
+            if error is None:
+                suc_genes.append(done_gene)
+                if refresh is not None:
+                    refresh.Commit(done_gene)
+            else:
+                fail_genes[done_gene] = error
+                journal.Fail(done_gene, error)
+                if refresh is not None:
+                    refresh.Discard(done_gene)
+
+    try:
+        for gene, formatted, error in tqdm(stream, desc='Iterating over all genes', unit='gene', total=n_selected):  # noqa
+            # payloads unchanged since the last refresh are None
+            changed_tags = [data_tag for data_tag in data_tags if error is None and formatted[data_tag] is not None]  # noqa
+            if len(changed_tags) > 0:
+                changed_genes.add(gene)
+            for raw_writer in raw_writers:
+                if error is None and raw_writer.data_tag in changed_tags:
+                    _, error = raw_writer.Add(gene, formatted[raw_writer.data_tag])[0]  # noqa
+            if error is not None:
+                RecordOutcomes([(gene, error)])
+                continue
+            if writer is None or parsed_tags[0] not in changed_tags:
+                raw_files = {raw_writer.FileName(gene): os.path.getsize(raw_writer.FileName(gene)) for raw_writer in raw_writers if raw_writer.data_tag in changed_tags}  # noqa
+                if len(raw_files) > 0:
+                    journal.Commit([gene], raw_files)
+                RecordOutcomes([(gene, None)])
+                continue
+            results, dtype = formatted[parsed_tags[0]]
+            if store is not None:
+                try:
+                    store.Add(gene, results)
+                except Exception as e:
+                    logger.error(f'Error occured when adding gene {gene} to the store: {e}')  # noqa
+                    RecordOutcomes([(gene, RuntimeError(f'STEP 4 - store output for gene {gene} failed: {e}'))])  # noqa
+                    continue
+                if output_matcher is not None:
+                    results = SelectPatternRows(gene, results, output_matcher)  # noqa
+            if matrix is not None:
+                try:
+                    matrix.Add(gene, results)
+                except Exception as e:
+                    logger.error(f'Error occured when adding gene {gene} to the matrix: {e}')  # noqa
+                    RecordOutcomes([(gene, RuntimeError(f'STEP 4 - matrix output for gene {gene} failed: {e}'))])  # noqa
+                    continue
+            if summary is not None:
+                summary.Add(results)
+            if 'regulation' in dtype:
+                results, dtype = DropRegulation(results, dtype)
+            outcomes = writer.Add(gene, results, dtype)
+            if len(outcomes) > 0 and matrix is not None:
+                matrix.Checkpoint()  # keep matrix in step with the journal
+            RecordOutcomes(outcomes)
+        if writer is not None:
+            RecordOutcomes(writer.Close())
+        if summary is not None:
+            summary_path = summary.Write(metadata.out_dir, metadata.data_pattern)  # noqa
+            print(f'Summary statistics of {summary.n_genes} genes are written to {summary_path}')  # noqa
+        if store is not None:
+            store.Close()
+            print(f'Formatted rows are stored in {metadata.store}, query them with "python RNAseqDB_fetch.py query --store {metadata.store} ..."')  # noqa
+        if matrix is not None:
+            matrix.Close()
+            print(f'Matrices of {len(matrix.genes)} genes x {len(matrix.treatments)} treatments are written to {matrix.prefix}_*')  # noqa
+    finally:
+        stream.close()
+        if matrix is not None and not matrix.closed:
+            matrix.Checkpoint()
+        if store is not None and not store.closed:
+            store.Close()
+        journal.Close()
+        if refresh is not None and writer is not None and not writer.closed and metadata.data_pattern != '':  # noqa
+            # earlier rows of changed genes are only dropped on Close, keep
+            # the state of the last complete refresh so the next one
+            # replaces these genes again
+            print(f'Refresh is interrupted, {refresh.path} is kept from the last complete refresh')  # noqa
+            logger.warning(f'Refresh is interrupted before earlier rows of changed genes were dropped, {refresh.path} is not updated')  # noqa
+        elif refresh is not None:
+            refresh.Save([gene for gene in suc_genes if gene in changed_genes])  # noqa
+        if refresh is not None:
+            metrics.counters.update(genes_changed=len(changed_genes & set(suc_genes)),  # noqa
+                                    genes_unchanged=len(set(suc_genes) - changed_genes))  # noqa
+        metrics.counters.update(requests=session.n_requests,
+                                retries=session.n_retries,
+                                throttled=session.n_throttled,
+                                genes_succeeded=len(suc_genes),
+                                genes_failed=len(fail_genes))
+        metrics_path = metrics.Dump(metadata.out_dir, metadata.metrics_format)  # noqa
+        if metrics_path is not None:
+            print(f'Run metrics are written to {metrics_path}')
+    print(f'In total {gene_reader.n_genes} genes are recognized from the gene list, {gene_reader.n_duplicates} duplicates are skipped')  # noqa
+    if refresh is not None:
+        changed = [gene for gene in suc_genes if gene in changed_genes]
+        print(f'{len(changed)} of {len(suc_genes)} genes changed since the last run, they are listed in {refresh.changed_path}')  # noqa
+        logger.info(f'Changed genes since the last run: {", ".join(changed) if changed else "none"}')  # noqa
+    if metadata.optimistic:
+        hits = metrics.counters.get('fast_path_hits', 0)
+        tried = hits + metrics.counters.get('fast_path_misses', 0)
+        if tried > 0:
+            print(f'Result files of {hits} of {tried} genes ({hits / tried:.1%}) were fetched without pre-search')  # noqa
+            logger.info(f'Fast path hit rate: {hits}/{tried} ({hits / tried:.1%})')  # noqa
+    for gene in ShardGenes(gene_reader.invalid_genes, metadata.shard):
+        fail_genes[gene] = ValueError(f'Gene ID {gene} does not match the ID pattern')  # noqa
     SummaryPrinter(suc_genes=suc_genes,
                    fail_genes=fail_genes)
+    if summary is not None:
+        summary.Print()
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['merge']:
+        MergeCli(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ['query']:
+        QueryCli(sys.argv[2:])
+        sys.exit(0)
     # intialize parser
     parser = argparse.ArgumentParser(description='Fetch RNA expression data from online database.')  # noqa
     # add parser arguments
@@ -475,32 +3100,185 @@ if __name__ == '__main__':
                         help='Format of the gene list file, either csv or txt (default: csv) ')  # noqa
     parser.add_argument('--list-sep', type=str, default=',',
                         help='Delimiter used in the gene list, either ",", ";" or "\t" (default: ",")')  # noqa
+    parser.add_argument('--id-pattern', type=str, default=r'AT[1-5CM]G\d{5}(\.\d+)?',
+                        help='Regular expression gene IDs must match, other IDs are reported as failed without any request, give "" to accept every ID (default: Arabidopsis AGI codes)')  # noqa
     parser.add_argument('--data-tag', type=str, default='tbox',
-                        help='Type of desired information, e.g. "tbox" for expression data under different treatments (default: tbox)')  # noqa
+                        help='Type(s) of desired information, comma-separated, e.g. "tbox" for expression data under different treatments, all tags of a gene are fetched after one pre-search, tags other than tbox are written as they are (default: tbox)')  # noqa
     parser.add_argument('--data-pattern', type=str, default='',
                         help='Motif(s) specifies experimental condition from which data will be extracted, e.g. flg22')  # noqa
+    parser.add_argument('--pattern-overlap', type=str, default='duplicate',
+                        help='How to treat a treatment matching several patterns, "duplicate" writes one row per matching pattern, "first" only keeps the first matching pattern (default: duplicate)')  # noqa
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Number of processes formatting downloaded data while further genes are fetched, 0 formats in the main process (default: 0)')  # noqa
+    parser.add_argument('--queue-size', type=int, default=0,
+                        help='Maximum number of genes held between two pipeline steps, bounds memory use (default: 0, four times the number of workers)')  # noqa
     parser.add_argument('--out-dir', type=str, default=os.path.dirname(__file__),  # noqa
                         help='Output directory for final results (default: current script directory)')  # noqa
+    parser.add_argument('--shard', type=str, default='',
+                        help='Only fetch shard i of N, e.g. 2/4, genes are assigned to shards by a hash of their ID, output, journal and log go to out-dir/shard-i-of-N, combine them with "merge" afterwards')  # noqa
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of genes fetched concurrently, pre-search and fetch of one gene always run in order (default: 1)')  # noqa
+    parser.add_argument('--max-per-host', type=int, default=4,
+                        help='Maximum number of in-flight requests per database host (default: 4)')  # noqa
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help='Seconds to wait for a connection to the database (default: 10)')  # noqa
+    parser.add_argument('--read-timeout', type=float, default=60,
+                        help='Seconds to wait for a response of the database (default: 60)')  # noqa
+    parser.add_argument('--max-retries', type=int, default=4,
+                        help='Retries of a request on status 429 / 5xx or connection errors, with exponential backoff and jitter, Retry-After of the server is honoured (default: 4)')  # noqa
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help='Maximum requests per second, the rate is halved whenever the server throttles and slowly recovers afterwards, 0 sends requests as fast as --workers / --max-per-host allow until the server first throttles (default: 0)')  # noqa
+    parser.add_argument('--breaker-threshold', type=int, default=10,
+                        help='Number of failed requests in a row after which all requests are paused (default: 10)')  # noqa
+    parser.add_argument('--breaker-pause', type=float, default=60,
+                        help='Seconds all requests are paused once --breaker-threshold is reached (default: 60)')  # noqa
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='Directory of the raw payload cache, payloads found there are not fetched again (default: no cache)')  # noqa
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24,
+                        help='Hours a cached payload stays valid (default: 168)')  # noqa
+    parser.add_argument('--cache-max-mb', type=float, default=1024,
+                        help='Size cap of the payload cache in MB, least recently used payloads are evicted first (default: 1024)')  # noqa
+    parser.add_argument('--optimistic', action='store_true',
+                        help='Fetch result files of a gene directly and only pre-search when they are missing or incomplete, the hit rate is reported at the end')  # noqa
+    parser.add_argument('--refresh', action='store_true',
+                        help='Incremental refresh of an earlier run in out-dir, requests are conditional (ETag / Last-Modified) and genes whose data did not change are neither formatted nor written, results of changed genes replace their earlier ones')  # noqa
+    parser.add_argument('--cache-only', action='store_true',
+                        help='Offline mode, serve payloads from the cache only and never touch the network')  # noqa
+    parser.add_argument('--out-format', type=str, default='csv',
+                        help='Format of output files, either csv, parquet or feather, the latter two need pyarrow (default: csv)')  # noqa
+    parser.add_argument('--partition-by-keyword', action='store_true',
+                        help='Partition parquet / feather output into one sub-directory per pattern, only with --data-pattern')  # noqa
+    parser.add_argument('--matrix', action='store_true',
+                        help='Also write gene x treatment_project matrices of mock / treated FPKM and log2FC as memory-mapped .npy files with gene and treatment index files, filled gene by gene')  # noqa
+    parser.add_argument('--store', type=str, default='',
+                        help='Also store every formatted row (all treatments, whatever --data-pattern) in this SQLite file, filter it offline with "python RNAseqDB_fetch.py query --store ..."')  # noqa
+    parser.add_argument('--summary', action='store_true',
+                        help='Also write per keyword and treatment_project statistics (genes up / down, mean and variance of log2FC, mock / treated FPKM quantiles) to {pattern}_summary.csv, computed while genes are written')  # noqa
+    parser.add_argument('--batch-rows', type=int, default=10000,
+                        help='Number of result rows buffered in memory before they are written to the output file (default: 10000)')  # noqa
+    parser.add_argument('--batch-mb', type=float, default=8,
+                        help='Size of buffered results in MB before they are written to the output file (default: 8)')  # noqa
+    parser.add_argument('--metrics-format', type=str, default='json',
+                        help='Format of the run metrics file written next to message.log, either json, prometheus or none (default: json)')  # noqa
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the formatting step with cProfile and tracemalloc, results are written to format_profile.txt / .prof in out-dir')  # noqa
+    parser.add_argument('--gene-log-sample', type=int, default=1,
+                        help='Only log progress messages of about every n-th gene, 0 turns them off (default: 1, every gene)')  # noqa
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, genes already written according to the journal in out-dir are skipped')  # noqa
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Only fetch genes that failed in previous runs according to the journal in out-dir')  # noqa
     args = parser.parse_args()
+    metadata = QueryMetaData()
     # change metainfo accordingly
     if args.base_url is None:
         pass  # no databse given, default database remains
+    else:
+        metadata.db_url = args.base_url if args.base_url.endswith('/') else args.base_url + '/'  # noqa
     if args.list_format in ['csv', 'txt']:
-        QueryMetaData.list_format = args.list_format  # noqa
+        metadata.list_format = args.list_format  # noqa
     else:
         raise ValueError(f'Gene list format can only be either csv or txt file, but got {args.list_format}!')  # noqa
     if args.list_sep in [',', ';', '\t']:
-        QueryMetaData.list_sep = args.list_sep
+        metadata.list_sep = args.list_sep
     else:
         raise ValueError(f'Gene list delimiter can only be either comma, semicolon or tab, but got {args.list_sep}!')  # noqa
-    QueryMetaData.gene_list = args.gene_list
-    QueryMetaData.data_tag = args.data_tag
-    QueryMetaData.data_pattern = args.data_pattern
-    QueryMetaData.out_dir = args.out_dir
+    metadata.gene_list = args.gene_list
+    try:
+        re.compile(args.id_pattern)
+    except re.error as e:
+        raise ValueError(f'Gene ID pattern is not a valid regular expression: {e}') from e  # noqa
+    metadata.id_pattern = args.id_pattern
+    SplitDataTags(args.data_tag)
+    metadata.data_tag = args.data_tag
+    metadata.data_pattern = args.data_pattern
+    if args.pattern_overlap in PatternMatcher.overlap_modes:
+        metadata.pattern_overlap = args.pattern_overlap
+    else:
+        raise ValueError(f'Pattern overlap mode can only be either duplicate or first, but got {args.pattern_overlap}!')  # noqa
+    metadata.out_dir = args.out_dir
+    if args.shard != '':
+        # every shard owns its directory, so shards never share a file
+        shard_index, n_shards = ParseShard(args.shard)
+        metadata.out_dir = os.path.join(args.out_dir, ShardDirName(shard_index, n_shards))  # noqa
+        os.makedirs(metadata.out_dir, exist_ok=True)
+    metadata.shard = args.shard
+    if args.workers < 1:
+        raise ValueError(f'Number of workers must be at least 1, but got {args.workers}!')  # noqa
+    metadata.workers = args.workers
+    if args.max_per_host < 1:
+        raise ValueError(f'Max in-flight requests per host must be at least 1, but got {args.max_per_host}!')  # noqa
+    metadata.max_per_host = args.max_per_host
+    if args.parse_workers < 0:
+        raise ValueError(f'Number of parse workers cannot be negative, but got {args.parse_workers}!')  # noqa
+    if args.parse_workers > 0 and args.profile:
+        raise ValueError('Profiling only covers formatting in the main process, please drop --parse-workers when using --profile!')  # noqa
+    metadata.parse_workers = args.parse_workers
+    if args.queue_size < 0:
+        raise ValueError(f'Queue size cannot be negative, but got {args.queue_size}!')  # noqa
+    metadata.queue_size = args.queue_size
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        raise ValueError('Timeouts must be positive!')
+    metadata.connect_timeout = args.connect_timeout
+    metadata.read_timeout = args.read_timeout
+    if args.max_retries < 0:
+        raise ValueError(f'Number of retries cannot be negative, but got {args.max_retries}!')  # noqa
+    metadata.max_retries = args.max_retries
+    if args.max_rate < 0:
+        raise ValueError(f'Max request rate cannot be negative, but got {args.max_rate}!')  # noqa
+    metadata.max_rate = args.max_rate
+    if args.breaker_threshold < 1:
+        raise ValueError(f'Circuit breaker threshold must be at least 1, but got {args.breaker_threshold}!')  # noqa
+    metadata.breaker_threshold = args.breaker_threshold
+    metadata.breaker_pause = args.breaker_pause
+    if args.cache_only and args.cache_dir == '':
+        raise ValueError('Cache-only mode needs a payload cache, please give --cache-dir!')  # noqa
+    metadata.cache_dir = args.cache_dir
+    metadata.cache_ttl = args.cache_ttl
+    metadata.cache_max_mb = args.cache_max_mb
+    metadata.cache_only = args.cache_only
+    metadata.optimistic = args.optimistic
+    if args.refresh and (args.resume or args.retry_failed or args.cache_only):  # noqa
+        raise ValueError('Refresh needs the database and a complete pass, please drop --resume / --retry-failed / --cache-only!')  # noqa
+    metadata.refresh = args.refresh
+    if args.out_format not in ResultsWriter.out_formats:
+        raise ValueError(f'Output format can only be either csv, parquet or feather, but got {args.out_format}!')  # noqa
+    metadata.out_format = args.out_format
+    if args.partition_by_keyword and (args.out_format == 'csv' or args.data_pattern == ''):  # noqa
+        raise ValueError('Partitioning by keyword needs --out-format parquet or feather and a --data-pattern!')  # noqa
+    metadata.partition_by_keyword = args.partition_by_keyword
+    if args.matrix and 'tbox' not in SplitDataTags(args.data_tag):
+        raise ValueError('Matrix output is built from tbox data, please include tbox in --data-tag!')  # noqa
+    metadata.matrix = args.matrix
+    if args.store != '' and 'tbox' not in SplitDataTags(args.data_tag):
+        raise ValueError('The results store is filled with tbox data, please include tbox in --data-tag!')  # noqa
+    metadata.store = args.store
+    if args.summary and 'tbox' not in SplitDataTags(args.data_tag):
+        raise ValueError('Summary statistics are computed from tbox data, please include tbox in --data-tag!')  # noqa
+    metadata.summary = args.summary
+    if args.batch_rows < 1:
+        raise ValueError(f'Batch size in rows must be at least 1, but got {args.batch_rows}!')  # noqa
+    metadata.batch_rows = args.batch_rows
+    if args.batch_mb <= 0:
+        raise ValueError(f'Batch size in MB must be positive, but got {args.batch_mb}!')  # noqa
+    metadata.batch_mb = args.batch_mb
+    if args.metrics_format not in ['json', 'prometheus', 'none']:
+        raise ValueError(f'Metrics format can only be either json, prometheus or none, but got {args.metrics_format}!')  # noqa
+    metadata.metrics_format = args.metrics_format
+    metadata.profile = args.profile
+    if args.gene_log_sample < 0:
+        raise ValueError(f'Gene log sample cannot be negative, but got {args.gene_log_sample}!')  # noqa
+    metadata.gene_log_sample = args.gene_log_sample
+    metadata.resume = args.resume
+    metadata.retry_failed = args.retry_failed
     # initialize logger
-    logging.basicConfig(filename=os.path.join(QueryMetaData.out_dir,'message.log'),
+    logging.basicConfig(filename=os.path.join(metadata.out_dir,'message.log'),
                         format='%(asctime)s - **%(levelname)s**: %(message)s',
                         level=logging.INFO)
     logger = logging.getLogger(__name__)
+    if metadata.gene_log_sample == 0:
+        gene_logger.setLevel(logging.WARNING)
+    elif metadata.gene_log_sample > 1:
+        gene_logger.addFilter(GeneLogSampler(metadata.gene_log_sample))
     # start main loop
-    main()
\ No newline at end of file
+    main(metadata)
\ No newline at end of file
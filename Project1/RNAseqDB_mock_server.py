@@ -0,0 +1,219 @@
+# ---- load packages ---- #
+
+import argparse
+import hashlib
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# ---- info ---- #
+
+# local stand-in for plantrnadb, serves 'Search.php?query=...' and
+# 'user/{gene}.tbox' with synthetic payloads in the 21-cell layout described
+# in data_structure.txt, used for benchmarks and offline testing
+
+
+# ---- params ---- #
+
+@dataclass
+class MockServerConfig:
+    '''
+    behaviour of the mock database server
+    '''
+    host: str = field(default='127.0.0.1')
+    port: int = field(default=8765)
+    latency_ms: float = field(default=20,
+                              metadata={'help': 'mean response latency in ms'})  # noqa
+    latency_jitter_ms: float = field(default=5,
+                                     metadata={'help': 'uniform jitter added to latency in ms'})  # noqa
+    error_rate: float = field(default=0.0,
+                              metadata={'help': 'fraction of requests answered with 503'})  # noqa
+    missing_rate: float = field(default=0.0,
+                                metadata={'help': 'fraction of genes without data (404)'})  # noqa
+    treatments: int = field(default=60,
+                            metadata={'help': 'number of treatment_project entries per gene'})  # noqa
+    require_presearch: bool = field(default=True,
+                                    metadata={'help': 'result files only exist after a pre-search'})  # noqa
+    revision: int = field(default=0,
+                          metadata={'help': 'data revision, a new revision changes the data of some genes'})  # noqa
+    changed_rate: float = field(default=0.1,
+                                metadata={'help': 'fraction of genes whose data differs in a new revision'})  # noqa
+
+
+# treatments used to build treatment_project labels, benchmark patterns
+# are taken from the start of this list
+TREATMENTS = ['flg22', 'elf18', 'chitin', 'pep1', 'nlp20', 'SA', 'JA', 'ABA',
+              'ethylene', 'IAA', 'GA3', 'BL', 'cold', 'heat', 'drought',
+              'salt', 'mannitol', 'UV', 'dark', 'wounding', 'hypoxia',
+              'Pst', 'Botrytis', 'nitrate']
+
+
+# ---- utils ---- #
+
+
+def GeneRandom(gene, salt=''):
+    '''
+    random generator seeded by gene ID so payloads are reproducible
+    '''
+    seed = hashlib.sha256(f'{gene}{salt}'.encode('utf-8')).digest()
+    return random.Random(int.from_bytes(seed[:8], 'big'))
+
+
+def SyntheticPayload(gene, treatments, revision=0, changed_rate=0.0):
+    '''
+    build a raw .tbox payload, a header row followed by one row of
+    up- and one row of down-regulated treatments, 7 cells each,
+    revision > 0 changes the payload of about changed_rate of all genes
+    '''
+    salt = ''
+    if revision > 0 and GeneRandom(gene, f'changed{revision}').random() < changed_rate:  # noqa
+        salt = f'revision{revision}'
+    rng = GeneRandom(gene, salt)
+    treatments = max(treatments, 2)  # at least one up- and one down-regulated
+    n_up = rng.randint(1, treatments - 1)
+    rows = ['group,tagname,FPKM,infotag,se,fc,contlib']
+    for regulation, n in (('up', n_up), ('down', treatments - n_up)):
+        labels, mock_fpkm, treated_fpkm = [], [], []
+        mock_se, treated_se, log2fc = [], [], []
+        mock_dpts, treated_dpts = [], []
+        for _ in range(n):
+            labels.append(f'{rng.choice(TREATMENTS)}_PRJNA{rng.randint(100000, 999999)}')  # noqa
+            mock = rng.uniform(0.5, 200)
+            fold = rng.uniform(1, 6) if regulation == 'up' else -rng.uniform(1, 6)  # noqa
+            treated = mock * 2 ** fold
+            mock_fpkm.append(f'{mock:.3f}')
+            treated_fpkm.append(f'{treated:.3f}')
+            mock_se.append(f'{mock * rng.uniform(0.01, 0.2):.3f}')
+            treated_se.append(f'{treated * rng.uniform(0.01, 0.2):.3f}')
+            log2fc.append(f'{fold:.3f}')
+            mock_dpts.append('|'.join(f'{mock * rng.uniform(0.8, 1.2):.2f}' for _ in range(3)))  # noqa
+            treated_dpts.append('|'.join(f'{treated * rng.uniform(0.8, 1.2):.2f}' for _ in range(3)))  # noqa
+        cells = [regulation,
+                 ';'.join(labels),
+                 ';'.join(mock_fpkm) + '_' + ';'.join(treated_fpkm),
+                 ';'.join(['mock'] * n) + '_' + ';'.join(['treated'] * n),
+                 ';'.join(mock_se) + '_' + ';'.join(treated_se),
+                 ';'.join(log2fc),
+                 ';'.join(mock_dpts) + '_' + ';'.join(treated_dpts)]
+        rows.append(','.join(cells))
+    return '\n'.join(rows) + '\n'
+
+
+class MockDbHandler(BaseHTTPRequestHandler):
+    config = MockServerConfig()
+    searched_genes = set()
+    lock = threading.Lock()
+    last_modified = formatdate(usegmt=True)
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+    def _Reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ReplyFile(self, body):
+        '''
+        serve a result file with validators, answer 304 if unchanged
+        '''
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        headers = {'ETag': etag, 'Last-Modified': self.last_modified}
+        if self.headers.get('If-None-Match') == etag:
+            return self._Reply(304, headers=headers)
+        return self._Reply(200, body, headers)
+
+    def do_GET(self):
+        config = self.config
+        delay = config.latency_ms + random.uniform(-config.latency_jitter_ms, config.latency_jitter_ms)  # noqa
+        time.sleep(max(0.0, delay) / 1000)
+        if random.random() < config.error_rate:
+            return self._Reply(503)
+        url = urlsplit(self.path)
+        if url.path.endswith('/Search.php'):
+            query = parse_qs(url.query).get('query', [''])[0]
+            gene = query.split('/')[0].upper()
+            with self.lock:
+                self.searched_genes.add(gene)
+            return self._Reply(200, b'ok')
+        if '/user/' in url.path:
+            gene, _, data_tag = url.path.rsplit('/', 1)[-1].partition('.')
+            gene = gene.upper()
+            if GeneRandom(gene, 'missing').random() < config.missing_rate:
+                return self._Reply(404)
+            if config.require_presearch:
+                with self.lock:
+                    searched = gene in self.searched_genes
+                if not searched:
+                    return self._Reply(404)
+            if data_tag != 'tbox':
+                return self._ReplyFile(f'{gene}\t{data_tag}\n'.encode('utf-8'))  # noqa
+            return self._ReplyFile(SyntheticPayload(gene, config.treatments, config.revision, config.changed_rate).encode('utf-8'))  # noqa
+        return self._Reply(404)
+
+
+def MockDbServer(config: MockServerConfig):
+    '''
+    bind a mock server without serving it yet, port 0 picks a free port
+    (see server.server_address), e.g. for tests serving it in a thread
+    '''
+    handler = type('ConfiguredMockDbHandler', (MockDbHandler,),
+                   {'config': config, 'searched_genes': set(),
+                    'lock': threading.Lock(),
+                    'last_modified': formatdate(usegmt=True)})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def ServeMockDb(config: MockServerConfig):
+    '''
+    run the mock server until interrupted, the database url is
+    http://{host}:{port}/athrdb/
+    '''
+    server = MockDbServer(config)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local mock of the RNAseq database.')  # noqa
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on (default: 8765)')
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help='Mean response latency in ms (default: 20)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with status 503 (default: 0)')  # noqa
+    parser.add_argument('--missing-rate', type=float, default=0.0,
+                        help='Fraction of genes without data, answered with status 404 (default: 0)')  # noqa
+    parser.add_argument('--treatments', type=int, default=60,
+                        help='Number of treatment_project entries per gene (default: 60)')  # noqa
+    parser.add_argument('--no-presearch', action='store_true',
+                        help='Serve result files without a preceding pre-search')  # noqa
+    parser.add_argument('--revision', type=int, default=0,
+                        help='Data revision, every revision > 0 changes the data of a share of genes (default: 0)')  # noqa
+    parser.add_argument('--changed-rate', type=float, default=0.1,
+                        help='Share of genes whose data differs in a revision (default: 0.1)')  # noqa
+    args = parser.parse_args()
+    config = MockServerConfig(port=args.port,
+                              latency_ms=args.latency_ms,
+                              error_rate=args.error_rate,
+                              missing_rate=args.missing_rate,
+                              treatments=args.treatments,
+                              require_presearch=not args.no_presearch,
+                              revision=args.revision,
+                              changed_rate=args.changed_rate)
+    print(f'Mock database is served at http://{config.host}:{config.port}/athrdb/')  # noqa
+    ServeMockDb(config)
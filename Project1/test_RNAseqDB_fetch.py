@@ -0,0 +1,305 @@
+# ---- load packages ---- #
+
+import itertools
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import RNAseqDB_fetch as fetch
+import RNAseqDB_mock_server as mock_db
+
+# ---- info ---- #
+
+# regression checks of payload parsing for blocks the mock server never
+# serves: empty up / down blocks and malformed (NA) numbers, and end-to-end
+# runs against the mock server (RNAseqDB_mock_server.py) served in a thread
+
+
+# ---- utils ---- #
+
+HEADER = 'group,tagname,FPKM,infotag,se,fc,contlib'
+UP = 'up,flg22_PRJNA1;SA_PRJNA2,1.5;2.5_3.5;4.5,mock;mock_treated;treated,0.1;0.2_0.3;0.4,1.0;2.0,1|1;2|2_3|3;4|4'  # noqa
+DOWN = 'down,cold_PRJNA3,5.5_6.5,mock_treated,0.5_0.6,-1.0,5|5_6|6'
+EMPTY_DOWN = 'down,,_,_,_,,_'
+EMPTY_UP = 'up,,_,_,_,,_'
+
+
+PATTERN = 'flg22_elf18_chitin_pep1_nlp20_SA'
+
+
+def Payload(*rows):
+    return '\n'.join((HEADER,) + rows) + '\n'
+
+
+@pytest.fixture
+def mock_server():
+    '''
+    start mock servers on free ports, returns their database urls
+    '''
+    servers = []
+
+    def Start(**kwargs):
+        config = mock_db.MockServerConfig(port=0, latency_ms=0,
+                                          latency_jitter_ms=0, treatments=8,
+                                          **kwargs)
+        server = mock_db.MockDbServer(config)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://{config.host}:{server.server_address[1]}/athrdb/'
+
+    yield Start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def gene_list(tmp_path):
+    path = tmp_path / 'genes.csv'
+    path.write_text(''.join(f'AT{i % 5 + 1}G{10000 + 37 * i:05d}\n' for i in range(60)))  # noqa
+    return str(path)
+
+
+def RunFetch(db_url, gene_list, out_dir, **kwargs):
+    os.makedirs(out_dir, exist_ok=True)
+    kwargs.setdefault('data_pattern', PATTERN)
+    metadata = fetch.QueryMetaData(db_url=db_url,
+                                   gene_list=gene_list,
+                                   out_dir=str(out_dir),
+                                   workers=4,
+                                   batch_rows=5,
+                                   metrics_format='none',
+                                   **kwargs)
+    fetch.main(metadata)
+
+
+def Interrupt(monkeypatch, after):
+    '''
+    make the next run stop with KeyboardInterrupt after some genes
+    '''
+    iter_formatted_genes = fetch.IterFormattedGenes
+
+    def IterThenInterrupt(*args, **kwargs):
+        stream = iter_formatted_genes(*args, **kwargs)
+        try:
+            for i, item in enumerate(stream):
+                if i == after:
+                    raise KeyboardInterrupt
+                yield item
+        finally:
+            stream.close()
+
+    monkeypatch.setattr(fetch, 'IterFormattedGenes', IterThenInterrupt)
+
+
+def ReadOutput(out_dir, out_format, data_pattern=PATTERN):
+    '''
+    rows of a pattern mode output, part files in name order
+    '''
+    path = fetch.OutputFileName(str(out_dir), data_pattern, '', out_format)
+    if out_format == 'csv':
+        return pd.read_csv(path)
+    import pyarrow.parquet
+    frames = []
+    for root, _, names in sorted(os.walk(path)):
+        for name in sorted(names):
+            df_part = pyarrow.parquet.read_table(os.path.join(root, name)).to_pandas()  # noqa
+            frames.append(df_part.astype({column: str for column in df_part.columns if isinstance(df_part[column].dtype, pd.CategoricalDtype)}))  # noqa
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize('with_regulation', [False, True])
+def test_empty_down_block(with_regulation):
+    content = Payload(UP, EMPTY_DOWN)
+    results, dtype = fetch.FormatRawDataFromDb('AT1G01010', content, '', with_regulation=with_regulation)  # noqa
+    assert results['treatment_project'] == ['flg22_PRJNA1', 'SA_PRJNA2']
+    assert results['avg_log2fc'].tolist() == [1.0, 2.0]
+    assert set(results) == set(dtype)
+    results, _ = fetch.FormatRawDataFromDb('AT1G01010', content, 'cold', with_regulation=with_regulation)  # noqa
+    assert results['treatment_project'] == []
+    fetch.ResultsToDataFrame(results, dtype)
+
+
+def test_empty_up_block():
+    content = Payload(EMPTY_UP, DOWN)
+    results, _ = fetch.FormatRawDataFromDb('AT1G01010', content, 'cold', with_regulation=True)  # noqa
+    assert results['treatment_project'] == ['cold_PRJNA3']
+    assert results['regulation'] == ['down']
+    assert results['expression_fpkm_treated'].tolist() == [6.5]
+
+
+def test_na_outside_selected_rows():
+    down = DOWN.replace('5.5_6.5', 'NA_6.5')
+    content = Payload(UP, down)
+    results, _ = fetch.FormatRawDataFromDb('AT1G01010', content, 'flg22_SA')
+    assert results['keyword'] == ['flg22', 'SA']
+    assert results['expression_fpkm_mock'].tolist() == [1.5, 2.5]
+    # whole extract (and --store) keep the row, NA becomes missing
+    results, dtype = fetch.FormatRawDataFromDb('AT1G01010', content, '')
+    assert np.isnan(results['expression_fpkm_mock'][2])
+    assert fetch.ResultsToDataFrame(results, dtype)['expression_fpkm_mock'].isna().sum() == 1  # noqa
+
+
+def test_too_few_numbers_fail_step_3():
+    with pytest.raises(ValueError, match='STEP 3'):
+        fetch.ParseFloatCell('AT1G01010', '1.0;NA', 3)
+    content = Payload(UP.replace(',1.0;2.0,', ',1.0,'), DOWN)
+    with pytest.raises(ValueError, match='STEP 3'):
+        fetch.FormatRawDataFromDb('AT1G01010', content, '')
+
+
+@pytest.mark.parametrize('out_format', ['csv', 'parquet'])
+def test_interrupted_refresh_is_repaired(mock_server, gene_list, tmp_path, monkeypatch, out_format):  # noqa
+    if out_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    out_dir = tmp_path / 'refreshed'
+    RunFetch(mock_server(), gene_list, out_dir, refresh=True, out_format=out_format)  # noqa
+    earlier_genes = set(ReadOutput(out_dir, out_format)['gene'])
+    revised_url = mock_server(revision=1, changed_rate=0.3)
+    with monkeypatch.context() as patch:
+        Interrupt(patch, after=40)
+        with pytest.raises(KeyboardInterrupt):
+            RunFetch(revised_url, gene_list, out_dir, refresh=True, out_format=out_format)  # noqa
+    RunFetch(revised_url, gene_list, tmp_path / 'clean', out_format=out_format)  # noqa
+    expected = ReadOutput(tmp_path / 'clean', out_format)
+    # the interrupted run left rows of changed genes next to their old ones
+    assert len(ReadOutput(out_dir, out_format)) > len(expected)
+    RunFetch(revised_url, gene_list, out_dir, refresh=True, out_format=out_format)  # noqa
+    results = ReadOutput(out_dir, out_format)
+    assert sorted(map(tuple, results.astype(str).values)) == sorted(map(tuple, expected.astype(str).values))  # noqa
+    # rows are replaced in place, only genes new to the output come last
+    in_earlier = results['gene'].isin(earlier_genes)
+    pd.testing.assert_frame_equal(results[in_earlier].reset_index(drop=True),
+                                  expected[expected['gene'].isin(earlier_genes)].reset_index(drop=True))  # noqa
+
+
+def test_stores_shared_by_two_runs(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    stores = [fetch.ResultsStore(path), fetch.ResultsStore(path)]
+    for store in stores:
+        # fail fast instead of waiting for a lock held by the other run
+        store.connection.execute('PRAGMA busy_timeout = 100')
+    try:
+        for i, gene in enumerate(['AT1G01010', 'AT1G01020', 'AT1G01030']):  # noqa
+            content = mock_db.SyntheticPayload(gene, treatments=8)
+            results, _ = fetch.FormatRawDataFromDb(gene, content, '', with_regulation=True)  # noqa
+            stores[i % 2].Add(gene, results)
+        results, _ = stores[0].Query()
+        assert set(results['gene']) == {'AT1G01010', 'AT1G01020', 'AT1G01030'}  # noqa
+        assert len(results['gene']) == 24
+    finally:
+        for store in stores:
+            store.Close()
+
+
+def test_cache_files_removed_by_another_run(tmp_path):
+    cache = fetch.PayloadCache(str(tmp_path / 'cache'), ttl_hours=1, max_mb=1)
+    payload = mock_db.SyntheticPayload('AT1G01010', treatments=8)
+    cache.Put('a', payload)
+    cache.Put('b', payload)
+    os.remove(cache.PathFor('a'))
+    assert cache.Get('a') is None
+    assert cache.Get('b') == payload
+    os.remove(cache.PathFor('b'))
+    # eviction meets a file that is gone already
+    cache.max_bytes = len(payload.encode('utf-8'))
+    cache.Put('c', payload)
+    assert cache.Get('c') == payload
+
+
+def test_cache_errors_do_not_fail_genes(mock_server, tmp_path):
+    db_url = mock_server()
+    cache_dir = tmp_path / 'cache'
+    cache = fetch.PayloadCache(str(cache_dir), ttl_hours=1, max_mb=1)
+    session = fetch.CreateRequestSession(fetch.QueryMetaData(db_url=db_url))
+    limiter = fetch.HostRequestLimiter(4)
+    cache_dir.rmdir()  # payloads cannot be cached any more
+    contents = fetch.FetchGeneContent('AT1G01010', session, db_url, ['tbox'], limiter, cache=cache)  # noqa
+    assert contents['tbox'] == mock_db.SyntheticPayload('AT1G01010', treatments=8)  # noqa
+
+
+@pytest.mark.parametrize('out_format', ['csv', 'parquet'])
+def test_resume_after_kill(mock_server, gene_list, tmp_path, monkeypatch, out_format):  # noqa
+    if out_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    db_url = mock_server()
+    out_dir = tmp_path / 'resumed'
+    with monkeypatch.context() as patch:
+        Interrupt(patch, after=30)
+        with pytest.raises(KeyboardInterrupt):
+            RunFetch(db_url, gene_list, out_dir, out_format=out_format)
+    # a kill also leaves a torn row / part file and a torn journal line
+    file_name = fetch.OutputFileName(str(out_dir), PATTERN, '', out_format)
+    if out_format == 'csv':
+        with open(file_name, 'ab') as w_file:
+            w_file.write(b'up,flg22_PRJNA1,1.')
+    else:
+        with open(os.path.join(file_name, 'part-torn.parquet'), 'wb') as w_file:  # noqa
+            w_file.write(b'PAR1')
+    journal_path = fetch.RunJournal.PathFor(str(out_dir), PATTERN, 'tbox')
+    with open(journal_path, 'a') as w_file:
+        w_file.write('{"stage": "writ')
+    assert len(fetch.ReadJournal(journal_path)[0]) > 0
+    RunFetch(db_url, gene_list, out_dir, out_format=out_format, resume=True)
+    RunFetch(db_url, gene_list, tmp_path / 'clean', out_format=out_format)
+    if out_format == 'csv':
+        with open(file_name, 'rb') as r_file:
+            resumed = r_file.read()
+        with open(fetch.OutputFileName(str(tmp_path / 'clean'), PATTERN, '', 'csv'), 'rb') as r_file:  # noqa
+            assert resumed == r_file.read()
+    else:
+        pd.testing.assert_frame_equal(ReadOutput(out_dir, out_format),
+                                      ReadOutput(tmp_path / 'clean', out_format))  # noqa
+
+
+@pytest.mark.parametrize('out_format', ['csv', 'parquet'])
+def test_merged_shards_match_single_run(mock_server, gene_list, tmp_path, out_format):  # noqa
+    if out_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    db_url = mock_server()
+    sharded_dir = tmp_path / 'sharded'
+    for index in range(1, 4):
+        RunFetch(db_url, gene_list, sharded_dir / fetch.ShardDirName(index, 3),  # noqa
+                 out_format=out_format, shard=f'{index}/3')
+    fetch.MergeShards(fetch.QueryMetaData(gene_list=gene_list,
+                                          out_dir=str(sharded_dir),
+                                          data_pattern=PATTERN,
+                                          out_format=out_format,
+                                          batch_rows=5))
+    RunFetch(db_url, gene_list, tmp_path / 'single', out_format=out_format)
+    if out_format == 'csv':
+        with open(fetch.OutputFileName(str(sharded_dir), PATTERN, '', 'csv'), 'rb') as r_file:  # noqa
+            merged = r_file.read()
+        with open(fetch.OutputFileName(str(tmp_path / 'single'), PATTERN, '', 'csv'), 'rb') as r_file:  # noqa
+            assert merged == r_file.read()
+    else:
+        pd.testing.assert_frame_equal(ReadOutput(sharded_dir, out_format),
+                                      ReadOutput(tmp_path / 'single', out_format))  # noqa
+
+
+def test_count_genes_matches_iteration(tmp_path):
+    path = tmp_path / 'genes.csv'
+    path.write_text('AT1G01010,at1g01020\nAT1G01010,,bad_id\nAT2G01010\n')
+    reader = fetch.ReadGenesfromList(str(path), 'csv', ',', r'AT[1-5CM]G\d{5}')  # noqa
+    assert reader.CountGenes() == 3
+    assert reader.CountGenes(lambda genes: fetch.ShardGenes(genes, '1/2')) == len(list(fetch.ShardGenes(iter(reader), '1/2')))  # noqa
+    # the counting pass leaves the counters of the actual pass alone
+    assert (reader.n_genes, reader.n_duplicates, reader.invalid_genes) == (3, 1, ['BAD_ID'])  # noqa
+
+
+def test_rate_is_only_limited_once_throttled():
+    statuses = itertools.chain([200] * 5, [503], itertools.repeat(200))
+    session = SimpleNamespace(get=lambda url, **kwargs: SimpleNamespace(status_code=next(statuses), headers={}))  # noqa
+    transport = fetch.RequestTransport(session, backoff_base=0)
+    for _ in range(5):
+        transport.get('http://127.0.0.1/athrdb/')
+    assert transport.rate is None
+    transport.get('http://127.0.0.1/athrdb/')  # throttled, then retried
+    assert transport.n_throttled == 1 and transport.rate is not None
+    for _ in range(20):
+        transport.get('http://127.0.0.1/athrdb/')
+    assert transport.rate is None